@@ -0,0 +1,147 @@
+import threading
+import logging
+import time
+import datetime
+import Controller
+
+class ActuatorBus(Controller.Controller):
+    """
+    Single hardware writer for a servo/PWM controller.
+    Callers post intents without blocking, the writer thread flushes them every tick.
+    Only the latest intent per output is kept (last write wins) and writes that don't change the output are dropped.
+    Exposes the ServoController and PWMController port methods so ports can use it as their controller.
+    """
+    DEBUG_INTERVAL = 5 * 60 # 5 minutes
+    IDLE_TIMEOUT = 1.0
+
+    def __init__(self, controller, log_level, tick=0.02):
+        super().__init__("ActuatorBus-{}".format(controller.name), log_level)
+        self.controller = controller
+        self.tick = tick
+        self.lock = threading.Lock()
+        self.intents = dict()
+        self.written = dict()
+        self.is_pending = threading.Event()
+        self.shutdown = True
+        self.run_thread = None
+        self.total_posted = 0
+        self.total_written = 0
+        self.total_unchanged = 0
+        #controllers able to update several ports in one transaction (e.g. PCA9685 block writes)
+        self.batch_funcs = dict()
+        if hasattr(controller, "set_positions"):
+            self.batch_funcs[controller.set_position] = controller.set_positions
+        if hasattr(controller, "set_duty_cycles"):
+            self.batch_funcs[controller.set_duty_cycle] = controller.set_duty_cycles
+
+    def start(self):
+        self.logger.debug("starting tick=%s", self.tick)
+        self.shutdown = False
+        self.run_thread = threading.Thread(target=self.run, args=())
+        self.run_thread.start()
+
+    def stop(self):
+        if self.shutdown:
+            self.logger.warning("Already stopped")
+            return
+
+        self.logger.debug("stopping")
+        self.shutdown = True
+        self.is_pending.set()
+        self.logger.debug("join th:%s", self.run_thread.getName())
+        self.run_thread.join()
+
+    def run(self):
+        self.logger.debug("running thread:%s", threading.current_thread().getName())
+        last_debug_dt = None
+        next_flush = time.monotonic()
+        try:
+            while not self.shutdown:
+                if self.is_pending.wait(self.IDLE_TIMEOUT):
+                    delay = next_flush - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    next_flush = time.monotonic() + self.tick
+                    self.flush()
+
+                ds = 1917 if last_debug_dt is None else (datetime.datetime.now()-last_debug_dt).total_seconds()
+                if ds>=self.DEBUG_INTERVAL:
+                    self.logger.debug("run posted:%s written:%s unchanged:%s", self.total_posted, self.total_written, self.total_unchanged)
+                    last_debug_dt = datetime.datetime.now()
+            #pending intents are written before the controller is stopped
+            self.flush()
+        except Exception as ex:
+            self.shutdown = True
+            self.logger.debug("exception %s", ex)
+
+        self.logger.debug("terminated")
+
+    def post(self, key, func, *args):
+        self.lock.acquire()
+        try:
+            self.intents[key] = (func, args)
+            self.total_posted += 1
+        finally:
+            self.lock.release()
+        self.is_pending.set()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            intents = self.intents
+            self.intents = dict()
+            self.is_pending.clear()
+        finally:
+            self.lock.release()
+
+        batch = dict()
+        for key, intent in intents.items():
+            if self.written.get(key) == intent:
+                self.total_unchanged += 1
+                continue
+            func, args = intent
+            batch_func = self.batch_funcs.get(func)
+            if batch_func is not None and args[0] >= 0:
+                if batch_func not in batch:
+                    batch[batch_func] = dict()
+                batch[batch_func][args[0]] = args[1]
+                self.written[key] = intent
+                continue
+
+            #keeps the order between batched and single writes
+            self.flush_batch(batch)
+            batch = dict()
+            try:
+                func(*args)
+            except Exception as ex:
+                self.logger.error("write key=%s ex=%s", key, ex)
+                continue
+            if key[1] < 0:
+                #port -1 drives every output of the controller
+                self.written = { k: v for k, v in self.written.items() if k[0] != key[0] }
+            self.written[key] = intent
+            self.total_written += 1
+        self.flush_batch(batch)
+
+    def flush_batch(self, batch):
+        for batch_func, values in batch.items():
+            try:
+                batch_func(values)
+                self.total_written += len(values)
+            except Exception as ex:
+                self.logger.error("batch write ports=%s ex=%s", list(values), ex)
+                for port in values:
+                    self.written.pop(("output", port), None)
+
+    #position, release and duty cycle drive the same output
+    def set_position(self, port, position_in_us):
+        self.post(("output", port), self.controller.set_position, port, position_in_us)
+
+    def release(self, port):
+        self.post(("output", port), self.controller.release, port)
+
+    def set_duty_cycle(self, port, value):
+        self.post(("output", port), self.controller.set_duty_cycle, port, value)
+
+    def set_speed(self, port, speed):
+        self.post(("speed", port), self.controller.set_speed, port, speed)
@@ -0,0 +1,96 @@
+import threading
+import logging
+import time
+import Controller
+
+class AdaptiveQuality(Controller.Controller):
+    """
+    Picks the jpg quality and the resolution scale the camera encodes with.
+    Viewers report how fast they drain frames, the encoder reports the encoded frame sizes.
+    The frame size budget is the slowest viewer's rate divided by the target fps:
+    above the budget the quality drops first and then the resolution, below it the resolution comes back first.
+    """
+    ADJUST_INTERVAL = 1.0
+    QUALITY_STEP = 5
+    SCALE_STEP = 0.75
+    #exponential moving average weight of a new sample
+    SMOOTHING = 0.2
+    #a viewer's rate is ignored when it hasn't been sent to for this long
+    RATE_TIMEOUT = 5.0
+    #frames above HIGH_WATER * budget lower the quality, below LOW_WATER * budget raise it
+    HIGH_WATER = 0.9
+    LOW_WATER = 0.6
+
+    def __init__(self, log_level, target_fps, quality=95, min_quality=40, max_quality=None, min_scale=0.5):
+        super().__init__("AdaptiveQuality", log_level)
+        self.target_fps = target_fps
+        self.quality = quality
+        self.min_quality = min_quality
+        self.max_quality = max_quality or quality
+        self.scale = 1.0
+        self.min_scale = min_scale
+        self.lock = threading.Lock()
+        #client => (bytes per second, last report time)
+        self.rates = dict()
+        self.frame_size = None
+        self.next_adjust_time = 0
+
+    def frame_encoded(self, size):
+        #encoder thread(s)
+        self.lock.acquire()
+        try:
+            self.frame_size = size if self.frame_size is None else self.frame_size + self.SMOOTHING * (size - self.frame_size)
+            now = time.monotonic()
+            if now >= self.next_adjust_time:
+                self.next_adjust_time = now + self.ADJUST_INTERVAL
+                self.adjust(now)
+        finally:
+            self.lock.release()
+
+    def client_sent(self, client, size, seconds):
+        #viewer sender threads, the send time only tracks the link when the socket buffer is full
+        if seconds <= 0:
+            return
+        rate = size / seconds
+        self.lock.acquire()
+        try:
+            if client in self.rates:
+                rate = self.rates[client][0] + self.SMOOTHING * (rate - self.rates[client][0])
+            self.rates[client] = (rate, time.monotonic())
+        finally:
+            self.lock.release()
+
+    def client_removed(self, client):
+        self.lock.acquire()
+        try:
+            self.rates.pop(client, None)
+        finally:
+            self.lock.release()
+
+    def get_rate(self, now):
+        rates = [rate for rate, report_time in self.rates.values() if now - report_time < self.RATE_TIMEOUT]
+        return min(rates) if len(rates) > 0 else None
+
+    def adjust(self, now):
+        rate = self.get_rate(now)
+        if rate is None or self.frame_size is None:
+            return
+        budget = rate / self.target_fps
+        quality = self.quality
+        scale = self.scale
+        if self.frame_size > budget * self.HIGH_WATER:
+            if quality > self.min_quality:
+                quality = max(self.min_quality, quality - self.QUALITY_STEP)
+            elif scale > self.min_scale:
+                scale = max(self.min_scale, scale * self.SCALE_STEP)
+        elif self.frame_size < budget * self.LOW_WATER:
+            if scale < 1.0:
+                scale = min(1.0, scale / self.SCALE_STEP)
+            elif quality < self.max_quality:
+                quality = min(self.max_quality, quality + self.QUALITY_STEP)
+
+        if quality != self.quality or scale != self.scale:
+            self.logger.info("adjust quality:%s=>%s scale:%.2f=>%.2f frame_size:%d budget:%d rate:%d",
+                             self.quality, quality, self.scale, scale, self.frame_size, budget, rate)
+            self.quality = quality
+            self.scale = scale
@@ -0,0 +1,176 @@
+import threading
+import logging
+import asyncio
+import socket
+import concurrent.futures
+import Controller
+
+class AsyncNetEngine(Controller.Controller):
+    """
+    Runs every asyncio server on a single event loop thread.
+    Blocking hardware calls are sent to a small executor so they never stall the loop.
+    """
+    STOP_TIMEOUT = 5
+
+    def __init__(self, log_level, hardware_workers=2):
+        super().__init__("AsyncNetEngine", log_level)
+        self.hardware_workers = hardware_workers
+        self.loop = None
+        self.executor = None
+        self.run_thread = None
+
+    def start(self):
+        self.logger.debug("starting hardware_workers=%s", self.hardware_workers)
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.hardware_workers, thread_name_prefix="hardware")
+        self.run_thread = threading.Thread(target=self.run, args=())
+        self.run_thread.start()
+
+    def stop(self):
+        if self.run_thread is None:
+            self.logger.warning("Already stopped")
+            return
+        self.logger.debug("stopping....")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.logger.debug("join th:%s run_thread", self.run_thread.getName())
+        self.run_thread.join()
+        self.run_thread = None
+        self.executor.shutdown(wait=True)
+        self.loop.close()
+        self.logger.debug("stopped")
+
+    def run(self):
+        self.logger.debug("running thread:%s", threading.current_thread().getName())
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        except Exception as ex:
+            self.logger.error("run ex=%s", ex)
+        self.logger.debug("terminated")
+
+    def call_soon(self, callback, *args):
+        #thread safe
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def run_coroutine(self, coro):
+        #thread safe, returns a concurrent.futures.Future
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run_hardware(self, func, *args):
+        #event loop only, returns an asyncio future
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+
+class AsyncTcpClient(asyncio.Protocol):
+    #frames are dropped while the transport holds more than this (slow viewers)
+    MAX_WRITE_BUFFER = 512 * 1024
+
+    def __init__(self, name, server):
+        self.name = name
+        self.server = server
+        self.transport = None
+        self.client_address = None
+        self.logger = logging.getLogger(name)
+        self.logger.setLevel(server.log_level)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.client_address = transport.get_extra_info("peername")
+        self.logger = logging.getLogger("{}-{}".format(self.name, self.client_address))
+        self.logger.setLevel(self.server.log_level)
+        self.logger.info("accepted client connection from %s", self.client_address)
+        self.server.register_client(self)
+
+    def connection_lost(self, ex):
+        self.logger.debug("connection lost ex=%s", ex)
+        self.server.unregister_client(self)
+        self.transport = None
+
+    def data_received(self, data):
+        self.logger.debug("run: data %s", data)
+
+    def send(self, data):
+        #event loop only
+        if self.transport is None or self.transport.is_closing():
+            return
+        if self.transport.get_write_buffer_size() > self.MAX_WRITE_BUFFER:
+            self.logger.debug("send dropped len=%s", len(data))
+            return
+        self.transport.write(data)
+
+    def send_buffers(self, buffers):
+        #event loop only, the buffers are not joined
+        if self.transport is None or self.transport.is_closing():
+            return
+        if self.transport.get_write_buffer_size() > self.MAX_WRITE_BUFFER:
+            self.logger.debug("send dropped len=%s", sum(len(data) for data in buffers))
+            return
+        self.transport.writelines(buffers)
+
+    def stop(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class AsyncTcpServer(Controller.Controller):
+    def __init__(self, name, engine, address, log_level):
+        super().__init__(name, log_level)
+        self.engine = engine
+        self.address = address
+        self.shutdown = False
+        self.lock = threading.Lock()
+        self.clients = []
+        self.server = None
+
+    def get_client_instance(self):
+        return AsyncTcpClient("AsyncTcpClient", self)
+
+    def start(self):
+        self.logger.debug("starting up on %s", self.address)
+        try:
+            future = self.engine.run_coroutine(self.engine.loop.create_server(self.get_client_instance, self.address[0], self.address[1], reuse_address=True))
+            self.server = future.result(self.engine.STOP_TIMEOUT)
+        except Exception as ex:
+            self.shutdown = True
+            self.logger.error("start ex=%s", ex)
+
+    def stop(self):
+        self.logger.debug("stopping....")
+        self.shutdown = True
+        if self.server is not None:
+            try:
+                self.engine.run_coroutine(self.close()).result(self.engine.STOP_TIMEOUT)
+            except Exception as ex:
+                self.logger.debug("stop ex=%s", ex)
+        self.logger.debug("stopped")
+
+    async def close(self):
+        self.server.close()
+        for client in self.clients.copy():
+            client.stop()
+        await self.server.wait_closed()
+
+    def register_client(self, client):
+        self.lock.acquire()
+        try:
+            self.clients.append(client)
+            self.logger.debug("register client:%s #clients:%s", client.client_address, len(self.clients))
+        finally:
+            self.lock.release()
+
+    def unregister_client(self, client):
+        self.lock.acquire()
+        try:
+            if client in self.clients:
+                self.clients.remove(client)
+                self.logger.debug("unregister client:%s #clients:%s", client.client_address, len(self.clients))
+        finally:
+            self.lock.release()
+
+    def send_image(self, data):
+        #called from the camera thread
+        self.engine.call_soon(self.send_all, data)
+
+    def send_all(self, data):
+        for client in self.clients.copy():
+            client.send(data)
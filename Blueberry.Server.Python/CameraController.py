@@ -6,14 +6,78 @@ import io
 import datetime
 import time
 import socket
+import collections
 import Controller
 
+class FramePacer:
+    """
+    Paces a capture loop on time.monotonic() deadlines (previous deadline + period), so the loop's own work doesn't
+    lower the frame rate. When a deadline is missed by a whole period the missed slots are skipped instead of
+    bursting frames to catch up.
+    Keeps the inter-frame intervals of the last WINDOW frames for the achieved fps and the jitter percentiles.
+    """
+    WINDOW = 300
+
+    def __init__(self, framerate):
+        self.period = 1.0 / framerate
+        self.intervals = collections.deque(maxlen=self.WINDOW)
+        self.total_frames = 0
+        self.total_late = 0
+        self.total_skipped = 0
+        self.reset()
+
+    def reset(self):
+        #after a pause the next frame starts a new schedule
+        self.deadline = None
+        self.last_frame_time = None
+
+    def wait(self):
+        now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = now
+        elif now < self.deadline:
+            time.sleep(self.deadline - now)
+            now = time.monotonic()
+        elif now - self.deadline >= self.period:
+            skipped = int((now - self.deadline) / self.period)
+            self.total_late += 1
+            self.total_skipped += skipped
+            self.deadline += skipped * self.period
+        self.deadline += self.period
+        self.mark(now)
+
+    def mark(self, now=None):
+        #frame captured, for sources paced by the device
+        if now is None:
+            now = time.monotonic()
+        if self.last_frame_time is not None:
+            self.intervals.append(now - self.last_frame_time)
+        self.last_frame_time = now
+        self.total_frames += 1
+
+    def percentile(self, sorted_values, percent):
+        return sorted_values[int(round(percent / 100.0 * (len(sorted_values) - 1)))]
+
+    def get_stats(self):
+        #(achieved fps, jitter p50, p95, p99 in seconds) over the window, None before two frames
+        if len(self.intervals) == 0:
+            return None
+        elapsed = sum(self.intervals)
+        fps = len(self.intervals) / elapsed if elapsed > 0 else 0
+        jitter = sorted(abs(interval - self.period) for interval in self.intervals)
+        return (fps, self.percentile(jitter, 50), self.percentile(jitter, 95), self.percentile(jitter, 99))
+
 class CameraController(Controller.Controller):
     TAG_EZ_IMAGE = bytearray(b"EZIMG") 
+    #on demand: how often an idle capture loop checks for shutdown
+    IDLE_TIMEOUT = 1.0
+    STATS_INTERVAL = 60
 
     def __init__(self, name, server, resolution, framerate, log_level):
         self.name = name
         self.server = server
+        #every server gets each frame (e.g. EZB camera protocol and http)
+        self.servers = [server]
         self.resolution = resolution
         self.framerate = framerate
         self.log_level = log_level
@@ -21,6 +85,107 @@ class CameraController(Controller.Controller):
         self.logger.setLevel(log_level)
         self.shutdown = False
         self.run_thread = None
+        #on demand capture (see enable_on_demand), the server reports the number of viewers
+        self.on_demand = False
+        self.linger = 0
+        self.warm_up = 0
+        self.viewers = 0
+        self.server_viewers = dict()
+        self.idle_time = None
+        self.warm_up_time = 0
+        self.demand = threading.Condition()
+        #MotionGate for controllers with raw frames (see enable_motion_gate)
+        self.motion_gate = None
+        self.pacer = FramePacer(framerate)
+        self.last_stats_dt = None
+
+    def pace(self):
+        #capture loops call it once per frame, sleeps until the frame's deadline
+        self.pacer.wait()
+        self.log_stats()
+
+    def frame_captured(self):
+        #capture loops paced by the device (picamera) only record the frame
+        self.pacer.mark()
+        self.log_stats()
+
+    def log_stats(self):
+        ds = 1917 if self.last_stats_dt is None else (datetime.datetime.now()-self.last_stats_dt).total_seconds()
+        if ds<self.STATS_INTERVAL:
+            return
+        self.last_stats_dt = datetime.datetime.now()
+        stats = self.pacer.get_stats()
+        if stats is None:
+            return
+        fps, p50, p95, p99 = stats
+        self.logger.info("fps:%.1f/%s jitter p50:%.1fms p95:%.1fms p99:%.1fms frames:%s late:%s skipped:%s",
+                         fps, self.framerate, p50 * 1000, p95 * 1000, p99 * 1000,
+                         self.pacer.total_frames, self.pacer.total_late, self.pacer.total_skipped)
+
+    def enable_motion_gate(self, threshold, keep_alive):
+        #frames that barely changed since the last one sent are not encoded
+        import MotionGate
+        self.motion_gate = MotionGate.MotionGate(self.logger, threshold, keep_alive)
+
+    def is_motion(self, frame):
+        #frame: numpy array (height, width[, channels])
+        return self.motion_gate is None or self.motion_gate.check(frame)
+
+    def enable_on_demand(self, linger=5.0, warm_up=0.5):
+        #capture stops linger seconds after the last viewer leaves
+        #frames captured during the first warm_up seconds after a restart are discarded (stale buffers, exposure)
+        self.on_demand = True
+        self.linger = linger
+        self.warm_up = warm_up
+
+    def add_server(self, server):
+        self.servers.append(server)
+
+    def set_viewers(self, server, count):
+        #viewers connected to server
+        self.demand.acquire()
+        try:
+            self.server_viewers[server] = count
+            count = sum(self.server_viewers.values())
+            if count == 0 and self.viewers > 0:
+                self.idle_time = time.monotonic()
+            self.viewers = count
+            self.demand.notify_all()
+        finally:
+            self.demand.release()
+
+    def wait_for_viewers(self):
+        #capture loops call it before every frame, blocks while nobody is watching
+        #returns False on shutdown
+        if not self.on_demand:
+            return not self.shutdown
+        self.demand.acquire()
+        try:
+            paused = False
+            while not self.shutdown and self.viewers == 0:
+                if not paused and self.idle_time is not None and time.monotonic() < self.idle_time + self.linger:
+                    #keep capturing while lingering
+                    return True
+                if not paused:
+                    self.logger.info("no viewers, capture paused")
+                    paused = True
+                self.demand.wait(self.IDLE_TIMEOUT)
+            if paused and not self.shutdown:
+                self.logger.info("viewers:%s, capture resumed", self.viewers)
+                self.pacer.reset()
+                self.warm_up_time = time.monotonic() + self.warm_up
+            return not self.shutdown
+        finally:
+            self.demand.release()
+
+    def is_wanted(self):
+        #non blocking version of wait_for_viewers
+        if not self.on_demand or self.viewers > 0:
+            return True
+        return self.idle_time is not None and time.monotonic() < self.idle_time + self.linger
+
+    def is_warming_up(self):
+        return time.monotonic() < self.warm_up_time
 
     def setup(self):
         return True
@@ -40,7 +205,12 @@ class CameraController(Controller.Controller):
             return
 
         self.logger.debug("stopping")
-        self.shutdown = True
+        self.demand.acquire()
+        try:
+            self.shutdown = True
+            self.demand.notify_all()
+        finally:
+            self.demand.release()
         if self.run_thread is not None:
             self.logger.debug("join th:%s", self.run_thread.getName())
             self.run_thread.join()
@@ -76,9 +246,9 @@ class CameraController(Controller.Controller):
             self.server.send_image(bytes(data))
 
     def send_image(self, img_bytes):
-        data = bytearray()
-        data += self.TAG_EZ_IMAGE
-        img_len = len(img_bytes)
-        data += img_len.to_bytes(4, "little")
-        data += img_bytes
-        self.server.send_image(bytes(data))
\ No newline at end of file
+        #frame = (9 bytes header, jpg): the jpg is never copied into a framed buffer,
+        #every client sends the same immutable jpg object after its header (scatter-gather)
+        header = bytes(self.TAG_EZ_IMAGE) + len(img_bytes).to_bytes(4, "little")
+        frame = (header, img_bytes)
+        for server in self.servers:
+            server.send_image(frame)
\ No newline at end of file
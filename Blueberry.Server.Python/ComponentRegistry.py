@@ -1,15 +1,57 @@
 import Controller
 
+class PortTables:
+    """
+    Immutable snapshot of the index addressed port components.
+    A table entry is None when the port is not mapped.
+    """
+    __slots__ = ("servos", "pwms", "digitals", "uarts")
+
+    def __init__(self, servos, pwms, digitals, uarts):
+        self.servos = servos
+        self.pwms = pwms
+        self.digitals = digitals
+        self.uarts = uarts
+
 class ComponentRegistry:
     Components = dict()
     Controllers = []
 
+    #component key prefix => (PortTables attribute, number of ports)
+    PORT_TABLES = {
+        "S": ("servos", 24),
+        "P": ("pwms", 24),
+        "D": ("digitals", 24),
+        "uart": ("uarts", 3),
+    }
+    Ports = PortTables((None,) * 24, (None,) * 24, (None,) * 24, (None,) * 3)
+
     def register_component(key, component):
         ComponentRegistry.Components[key] = component
+        ComponentRegistry.publish_port(key, component)
 
     def get_component(key):
         return None if key not in ComponentRegistry.Components else ComponentRegistry.Components[key]
 
+    def get_port_tables():
+        #tables are replaced (never mutated) when a port is registered, callers can keep the reference
+        return ComponentRegistry.Ports
+
+    def publish_port(key, component):
+        prefix = key.rstrip("0123456789")
+        if prefix not in ComponentRegistry.PORT_TABLES or prefix == key:
+            return
+        attr, count = ComponentRegistry.PORT_TABLES[prefix]
+        port = int(key[len(prefix):])
+        if port >= count:
+            return
+        ports = ComponentRegistry.Ports
+        table = list(getattr(ports, attr))
+        table[port] = component
+        tables = { name: getattr(ports, name) for name in PortTables.__slots__ }
+        tables[attr] = tuple(table)
+        ComponentRegistry.Ports = PortTables(**tables)
+
     def register_controller(controller):
          if not isinstance(controller, Controller.Controller):
              raise TypeError("not a controller")
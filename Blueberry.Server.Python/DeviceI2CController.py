@@ -4,6 +4,7 @@ import fcntl
 import I2CController
 import ctypes
 import array
+import threading
 
 # I2C C API constants (from linux kernel headers)
 I2C_M_TEN             = 0x0010  # this is a ten bit chip address
@@ -24,6 +25,12 @@ I2C_RDWR              = 0x0707  # Combined R/W transfer (one STOP only)
 I2C_PEC               = 0x0708  # != 0 to use PEC with SMBus
 I2C_SMBUS             = 0x0720  # SMBus transfer
 
+I2C_FUNC_I2C          = 0x00000001  # I2C_FUNCS: plain i2c-level commands (I2C_RDWR)
+
+
+class I2CError(IOError):
+    pass
+
 
 # ctypes versions of I2C structs defined by kernel.
 class i2c_msg(ctypes.Structure):
@@ -81,13 +88,17 @@ class DeviceI2CSlave(I2CController.I2CSlave):
         super().close()
 
     def write(self, data):
+        self.invalidate_shadow(data)
         try:
             self.logger.debug("write: %s", data)
             self._fd.write(bytes(data))
+            return True
         except Exception as ex:
             self.logger.error("writing: ex=%s", ex)
+        return False
 
     def read(self, bytes_to_read):
+        self.invalidate_shadow()
         try:
             data = self._fd.read(bytes_to_read)
             self.logger.debug("read: bytes_to_read:%s => data:%s", bytes_to_read, data)
@@ -109,37 +120,142 @@ class DeviceI2CSlave(I2CController.I2CSlave):
         self.logger.debug("write_read_data: byte_to_write:%s bytes_to_read:%s => data:%s", byte_to_write, bytes_to_read, data)
         return data
 
+class SharedBusI2CSlave(I2CController.I2CSlave):
+    """
+    Slave without its own fd, every transfer goes through the controller's bus fd
+    as an I2C_RDWR message carrying the slave address.
+    """
+
+    def write(self, data):
+        #the controller's transfer invalidates the shadow
+        try:
+            self.logger.debug("write: %s", data)
+            data = bytes(data)
+            self.controller.transfer([I2CController.I2CMessage(self.i2c_addr, False, len(data), data)])
+            return True
+        except Exception as ex:
+            self.logger.error("writing: ex=%s", ex)
+        return False
+
+    def read(self, bytes_to_read):
+        self.invalidate_shadow()
+        try:
+            message = I2CController.I2CMessage(self.i2c_addr, True, bytes_to_read)
+            self.controller.transfer([message])
+            self.logger.debug("read: bytes_to_read:%s => data:%s", bytes_to_read, message.data)
+            return message.data
+        except Exception as ex:
+            self.logger.error("reading: ex=%s", ex)
+        return bytes()
+
+    def write_read_data(self, byte_to_write, bytes_to_read):
+        message = I2CController.I2CMessage(self.i2c_addr, True, bytes_to_read)
+        self.controller.transfer([
+            I2CController.I2CMessage(self.i2c_addr, False, 1, bytes([byte_to_write])),
+            message
+        ])
+        self.logger.debug("write_read_data: byte_to_write:%s bytes_to_read:%s => data:%s", byte_to_write, bytes_to_read, message.data)
+        return message.data
+
 class DeviceI2CController(I2CController.I2CController):
+    #kernel limit (I2C_RDWR_IOCTL_MAX_MSGS) of messages per I2C_RDWR ioctl
+    MAX_RDWR_MESSAGES = 42
    
-    def __init__(self, bus, log_level):
+    def __init__(self, bus, log_level, shared_fd=False):
         super().__init__("DeviceI2CController-{}".format(bus), log_level)
         self.bus = bus
+        #shared_fd: one fd for the bus, slaves are plain dictionary entries
+        self.shared_fd = shared_fd
+        self._bus_fd = None
+        self._bus_fd_lock = threading.Lock()
+
+    def start(self):
+        if self.shared_fd:
+            self.get_bus_fd()
+
+    def get_bus_fd(self):
+        #I2C_RDWR messages carry their own address, no I2C_SLAVE needed
+        if self._bus_fd is None:
+            self._bus_fd_lock.acquire()
+            try:
+                if self._bus_fd is None:
+                    fd = io.open(self.get_dev_name(), "r+b", buffering=0)
+                    try:
+                        self.check_functions(fd)
+                    except:
+                        fd.close()
+                        raise
+                    self._bus_fd = fd
+            finally:
+                self._bus_fd_lock.release()
+        return self._bus_fd
+
+    def get_dev_name(self):
+        return "/dev/i2c-"+str(self.bus)
+
+    def check_functions(self, fd):
+        # Query supported functions
+        buf = array.array('I', [0])
+        try:
+            fcntl.ioctl(fd, I2C_FUNCS, buf, True)
+        except (OSError, IOError) as e:
+            raise I2CError(e.errno, "Querying supported functions: " + e.strerror)
+
+        # Check that I2C_RDWR ioctl() is supported on this device
+        if (buf[0] & I2C_FUNC_I2C) == 0:
+            raise I2CError(None, "I2C not supported on device \"{:s}\"".format(self.get_dev_name()))
+
+    def stop(self):
+        super().stop()
+        if self._bus_fd is not None:
+            self._bus_fd.close()
+            self._bus_fd = None
+
+    def transfer(self, messages):
+        #one I2C_RDWR ioctl: repeated starts between messages and a single STOP
+        self.invalidate_shadows(messages)
+        for ix in range(0, len(messages), self.MAX_RDWR_MESSAGES):
+            self.transfer_rdwr(messages[ix:ix + self.MAX_RDWR_MESSAGES])
+
+    def transfer_rdwr(self, messages):
+        buffers = []
+        rdwr = []
+        for message in messages:
+            if message.is_read:
+                buf = ctypes.create_string_buffer(message.length)
+                flags = I2C_M_RD
+            else:
+                buf = ctypes.create_string_buffer(message.data, message.length)
+                flags = 0
+            buffers.append(buf)
+            rdwr.append((message.i2c_addr, flags, message.length, ctypes.cast(buf, ctypes.POINTER(ctypes.c_uint8))))
+        request = make_i2c_rdwr_data(rdwr)
+        fcntl.ioctl(self.get_bus_fd(), I2C_RDWR, request)
+        for message, buf in zip(messages, buffers):
+            if message.is_read:
+                message.data = bytearray(buf.raw)
+        self.logger.debug("transfer: #messages:%s", len(messages))
 
     def create_slave(self, i2c_addr):
+        if self.shared_fd:
+            return SharedBusI2CSlave(self, i2c_addr)
+
         try:
-            dev_name = "/dev/i2c-"+str(self.bus)
+            dev_name = self.get_dev_name()
             fd = io.open(dev_name, "r+b", buffering=0)
             #self.logger.debug("opened: dev_name:%s fd:%s addr:%s", dev_name, fd, i2c_addr)
 
             fcntl.ioctl(fd, I2C_SLAVE, i2c_addr)
             slave = DeviceI2CSlave(self, i2c_addr, fd)
 
-            # Query supported functions
-            buf = array.array('I', [0])
             try:
-                fcntl.ioctl(fd, I2C_FUNCS, buf, True)
-            except (OSError, IOError) as e:
-                slave.close()
-                raise I2CError(e.errno, "Querying supported functions: " + e.strerror)
-
-            # Check that I2C_RDWR ioctl() is supported on this device
-            if (buf[0] & I2C_FUNCS) == 0:
+                self.check_functions(fd)
+            except:
                 slave.close()
-                raise I2CError(None, "I2C not supported on device \"{:s}\"".format(devpath))
+                raise
 
             return slave
         except Exception as ex:
             self.logger.error("opening: ex=%s", ex)
             return None
 
-
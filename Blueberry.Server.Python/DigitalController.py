@@ -2,11 +2,11 @@ import logging
 import Controller
 
 class DigitalPort:
+    __slots__ = ("digital_port_controller", "port")
+
     def __init__(self, digital_port_controller, port):
         self.digital_port_controller = digital_port_controller
         self.port = port
-        self.logger = logging.getLogger("{}-{}".format(digital_port_controller.name, port))
-        self.logger.setLevel(digital_port_controller.log_level)
 
     def set(self, state):
         self.digital_port_controller.set(self.port, state)
@@ -6,10 +6,12 @@ import io
 import datetime
 import time
 import socket
+import collections
 import TcpClient
 import TcpServer
 import UdpBroadcaster
 import ComponentRegistry
+import AsyncNetEngine
 
 class EZBCameraUdpBroadcaster(UdpBroadcaster.UdpBroadcaster):
     def __init__(self, server, delay, log_level):
@@ -20,44 +22,319 @@ class EZBCameraUdpBroadcaster(UdpBroadcaster.UdpBroadcaster):
         return "{}||{}-Server||{}||{}".format("Camera", hostname, addr, self.server.address[1])
 
 class EZBCameraTcpClient(TcpClient.TcpClient):
-    def __init__(self, server, client_socket, client_address):
-        super().__init__("EZBCameraTcpClient", server, client_socket, client_address)
+    """
+    Each viewer has its own sender thread, a slow viewer only drops its own frames.
+    The frame queue keeps the latest max_queued_frames frames (oldest dropped).
+    """
+    DEBUG_INTERVAL = 5 * 60 # 5 minutes
+
+    def __init__(self, server, client_socket, client_address, max_queued_frames=2, max_fps=0, name="EZBCameraTcpClient"):
+        #the run thread starts in TcpClient's constructor
+        self.frames = collections.deque(maxlen=max_queued_frames)
+        self.frames_ready = threading.Condition()
+        self.frame_interval = 1.0 / max_fps if max_fps > 0 else 0
+        self.total_queued = 0
+        self.total_sent = 0
+        self.total_dropped = 0
+        super().__init__(name, server, client_socket, client_address)
+        self.send_thread = threading.Thread(target=self.run_send, args=())
+        self.send_thread.start()
+
+    def stop(self):
+        self.frames_ready.acquire()
+        try:
+            self.shutdown = True
+            self.frames_ready.notify_all()
+        finally:
+            self.frames_ready.release()
+        super().stop()
+        self.logger.debug("join th:%s", self.send_thread.getName())
+        self.send_thread.join()
+
+    def run(self):
+        super().run()
+        if self.server.adaptive is not None:
+            self.server.adaptive.client_removed(self)
+        #connection closed, release the sender
+        self.frames_ready.acquire()
+        try:
+            self.shutdown = True
+            self.frames_ready.notify_all()
+        finally:
+            self.frames_ready.release()
+
+    def queue_frame(self, frame):
+        #camera thread, never blocks
+        #frame: (header, jpg) buffers, see CameraController.send_image
+        self.frames_ready.acquire()
+        try:
+            if len(self.frames) == self.frames.maxlen:
+                self.total_dropped += 1
+            self.frames.append(frame)
+            self.total_queued += 1
+            self.frames_ready.notify()
+        finally:
+            self.frames_ready.release()
+
+    def next_frame(self, next_send_time):
+        self.frames_ready.acquire()
+        try:
+            while not self.shutdown:
+                delay = next_send_time - time.monotonic()
+                if delay > 0:
+                    #frame rate cap, newer frames keep replacing the queued ones
+                    self.frames_ready.wait(delay)
+                elif len(self.frames) == 0:
+                    self.frames_ready.wait()
+                elif self.frame_interval > 0:
+                    #capped viewers only get the newest frame
+                    frame = self.frames.pop()
+                    self.total_dropped += len(self.frames)
+                    self.frames.clear()
+                    return frame
+                else:
+                    return self.frames.popleft()
+            return None
+        finally:
+            self.frames_ready.release()
+
+    def send_frame(self, frame):
+        return self.send_buffers(frame)
+
+    def run_send(self):
+        self.logger.debug("running thread:%s", threading.current_thread().getName())
+        last_debug_dt = None
+        next_send_time = 0
+        try:
+            while not self.shutdown:
+                frame = self.next_frame(next_send_time)
+                if frame is None:
+                    break
+                send_time = time.monotonic()
+                next_send_time = send_time + self.frame_interval
+                if not self.send_frame(frame):
+                    break
+                self.total_sent += 1
+                if self.server.adaptive is not None:
+                    self.server.adaptive.client_sent(self, len(frame[0]) + len(frame[1]), time.monotonic() - send_time)
+
+                ds = 1917 if last_debug_dt is None else (datetime.datetime.now()-last_debug_dt).total_seconds()
+                if ds>=self.DEBUG_INTERVAL:
+                    self.logger.debug("run_send queued:%s sent:%s dropped:%s", self.total_queued, self.total_sent, self.total_dropped)
+                    last_debug_dt = datetime.datetime.now()
+        except Exception as ex:
+            self.shutdown = True
+            self.logger.debug("send exception %s", ex)
+        self.logger.debug("send terminated")
 
 class EZBCameraTcpServer(TcpServer.TcpServer):
-    def __init__(self, address, log_level):
-        super().__init__("EZBCameraTcpServer", address, log_level)
+    def __init__(self, address, log_level, max_queued_frames=2, max_client_fps=0, name="EZBCameraTcpServer"):
+        super().__init__(name, address, log_level)
+        self.max_queued_frames = max_queued_frames
+        self.max_client_fps = max_client_fps
+        #new viewers get a picture right away
+        self.last_frame = None
+        #AdaptiveQuality fed with the viewers' send rates (optional)
+        self.adaptive = None
+        self.camera = None
 
     def get_client_instance(self, connection, client_address):
-        return EZBCameraTcpClient(self, connection, client_address)
+        client = EZBCameraTcpClient(self, connection, client_address, self.max_queued_frames, self.max_client_fps)
+        last_frame = self.last_frame
+        if last_frame is not None:
+            client.queue_frame(last_frame)
+        return client
+
+    def register_client(self, client):
+        super().register_client(client)
+        self.viewers_changed()
 
-    def send_image(self, data):
+    def unregister_client(self, client):
+        super().unregister_client(client)
+        self.viewers_changed()
+
+    def viewers_changed(self):
+        if self.camera is not None:
+            self.camera.set_viewers(self, len(self.clients))
+
+    def send_image(self, frame):
+        self.last_frame = frame
         clients = self.clients.copy()
         for client in clients: 
-            client.send(data)
+            client.queue_frame(frame)
+
+class AsyncEZBCameraTcpClient(AsyncNetEngine.AsyncTcpClient):
+    """
+    EZBCameraTcpClient's frame queue on the event loop: the transport holds one frame at a time,
+    the queue keeps the latest max_queued_frames frames (oldest dropped) and max_fps caps the viewer's frame rate.
+    """
+    DEBUG_INTERVAL = 5 * 60 # 5 minutes
+
+    def __init__(self, server, max_queued_frames=2, max_fps=0):
+        super().__init__("AsyncEZBCameraTcpClient", server)
+        self.frames = collections.deque(maxlen=max_queued_frames)
+        self.frame_interval = 1.0 / max_fps if max_fps > 0 else 0
+        self.next_send_time = 0
+        self.send_timer = None
+        #(size, send time) of the frame in the transport
+        self.sending = None
+        self.total_queued = 0
+        self.total_sent = 0
+        self.total_dropped = 0
+        self.last_debug_dt = None
+
+    def connection_made(self, transport):
+        #pause_writing as soon as anything is buffered, resume_writing once the transport drained
+        transport.set_write_buffer_limits(high=0, low=0)
+        super().connection_made(transport)
+
+    def connection_lost(self, ex):
+        super().connection_lost(ex)
+        if self.send_timer is not None:
+            self.send_timer.cancel()
+            self.send_timer = None
+        self.frames.clear()
+        if self.server.adaptive is not None:
+            self.server.adaptive.client_removed(self)
+
+    def resume_writing(self):
+        if self.sending is not None:
+            self.frame_sent()
+        self.send_next()
+
+    def queue_frame(self, frame):
+        #event loop only
+        #frame: (header, jpg) buffers, see CameraController.send_image
+        if len(self.frames) == self.frames.maxlen:
+            self.total_dropped += 1
+        self.frames.append(frame)
+        self.total_queued += 1
+        self.send_next()
 
-def start(addr, args):
-    server = EZBCameraTcpServer(addr, logging.DEBUG)
+    def on_send_timer(self):
+        self.send_timer = None
+        self.send_next()
+
+    def send_next(self):
+        while self.sending is None and self.send_timer is None and len(self.frames) > 0:
+            if self.transport is None or self.transport.is_closing():
+                return
+            now = time.monotonic()
+            delay = self.next_send_time - now
+            if delay > 0:
+                #frame rate cap, newer frames keep replacing the queued ones
+                self.send_timer = self.server.engine.loop.call_later(delay, self.on_send_timer)
+                return
+            if self.frame_interval > 0:
+                #capped viewers only get the newest frame
+                frame = self.frames.pop()
+                self.total_dropped += len(self.frames)
+                self.frames.clear()
+            else:
+                frame = self.frames.popleft()
+            self.next_send_time = now + self.frame_interval
+            self.sending = (len(frame[0]) + len(frame[1]), now)
+            self.send_buffers(frame)
+            if self.transport is None:
+                return
+            if self.transport.get_write_buffer_size() > 0:
+                #resume_writing sends the next one
+                return
+            self.frame_sent()
+
+    def frame_sent(self):
+        size, send_time = self.sending
+        self.sending = None
+        self.total_sent += 1
+        if self.server.adaptive is not None:
+            self.server.adaptive.client_sent(self, size, time.monotonic() - send_time)
+
+        ds = 1917 if self.last_debug_dt is None else (datetime.datetime.now()-self.last_debug_dt).total_seconds()
+        if ds>=self.DEBUG_INTERVAL:
+            self.logger.debug("queued:%s sent:%s dropped:%s", self.total_queued, self.total_sent, self.total_dropped)
+            self.last_debug_dt = datetime.datetime.now()
+
+class AsyncEZBCameraTcpServer(AsyncNetEngine.AsyncTcpServer):
+    def __init__(self, engine, address, log_level, max_queued_frames=2, max_client_fps=0):
+        super().__init__("AsyncEZBCameraTcpServer", engine, address, log_level)
+        self.max_queued_frames = max_queued_frames
+        self.max_client_fps = max_client_fps
+        self.last_frame = None
+        self.adaptive = None
+        self.camera = None
+
+    def get_client_instance(self):
+        return AsyncEZBCameraTcpClient(self, self.max_queued_frames, self.max_client_fps)
+
+    def register_client(self, client):
+        super().register_client(client)
+        self.viewers_changed()
+        if self.last_frame is not None:
+            client.queue_frame(self.last_frame)
+
+    def unregister_client(self, client):
+        super().unregister_client(client)
+        self.viewers_changed()
+
+    def viewers_changed(self):
+        if self.camera is not None:
+            self.camera.set_viewers(self, len(self.clients))
+
+    def send_all(self, frame):
+        #event loop
+        self.last_frame = frame
+        for client in self.clients.copy():
+            client.queue_frame(frame)
+
+def start(addr, args, engine=None):
+    if engine is None:
+        server = EZBCameraTcpServer(addr, logging.DEBUG, args.camclientqueue, args.camclientfps)
+    else:
+        server = AsyncEZBCameraTcpServer(engine, addr, logging.DEBUG, args.camclientqueue, args.camclientfps)
     ComponentRegistry.ComponentRegistry.register_controller(server)
 
     broadcaster = EZBCameraUdpBroadcaster(server, 3, logging.DEBUG)
     broadcaster.start()
     ComponentRegistry.ComponentRegistry.register_controller(broadcaster)
 
+    if args.camadaptive:
+        import AdaptiveQuality
+        server.adaptive = AdaptiveQuality.AdaptiveQuality(logging.DEBUG, args.camfps, args.jpgquality, args.jpgminquality, None, args.camminscale)
+
     camera = None
 
     if args.camtype == "videocapture":
         import OCVCamera
-        camera = OCVCamera.OCVCameraController(server, (args.camwidth, args.camheight), args.camfps, logging.DEBUG, args.videocaptureindex, args.jpgquality)
-        camera.start()
-        ComponentRegistry.ComponentRegistry.register_controller(camera)
+        camera = OCVCamera.OCVCameraController(server, (args.camwidth, args.camheight), args.camfps, logging.DEBUG, args.videocaptureindex, args.jpgquality, args.camencodeworkers, server.adaptive,
+                                            args.camrotation, args.camflip, args.mjpegpassthrough, args.mjpegfile)
     elif args.camtype == "picamera":
         import PiCameraController
-        camera = PiCameraController.PiCameraController(server, (args.camwidth, args.camheight), args.camfps, args.camrotation, args.camflip, logging.DEBUG)
-        camera.start()
-        ComponentRegistry.ComponentRegistry.register_controller(camera)
+        camera = PiCameraController.PiCameraController(server, (args.camwidth, args.camheight), args.camfps, args.camrotation, args.camflip, logging.DEBUG, args.picamoutput)
     elif args.camtype == "fake":
         import FakeCameraController
-        camera = FakeCameraController.FakeCameraController(server, (args.camwidth, args.camheight), args.camfps, logging.DEBUG)
+        sizes = None
+        if args.fakecamsizes is not None:
+            sizes = [tuple(int(v) for v in size.split("x")) for size in args.fakecamsizes.split(",")]
+        camera = FakeCameraController.FakeCameraController(server, (args.camwidth, args.camheight), args.camfps, logging.DEBUG,
+                                                           args.fakecamframes, sizes, args.fakecamentropy, args.fakecamstamp)
+
+    if camera is not None:
+        #the server reports viewer count changes to the camera
+        server.camera = camera
+        if args.camhttpport is not None:
+            import MJPEGHttpServer
+            http_server = MJPEGHttpServer.MJPEGHttpServer((args.camaddr, args.camhttpport), logging.DEBUG, args.camclientqueue, args.camclientfps)
+            http_server.camera = camera
+            camera.add_server(http_server)
+            ComponentRegistry.ComponentRegistry.register_controller(http_server)
+            http_server.start()
+        if args.camondemand:
+            camera.enable_on_demand(args.camlinger, args.camwarmup)
+        if args.cammotion > 0:
+            if args.camtype == "videocapture":
+                camera.enable_motion_gate(args.cammotion, args.cammotionkeepalive)
+            else:
+                logging.warning("--cammotion needs raw frames, only the videocapture camera supports it")
         camera.start()
         ComponentRegistry.ComponentRegistry.register_controller(camera)
 
@@ -0,0 +1,61 @@
+import os
+import time
+import struct
+import datetime
+
+#capture file: MAGIC followed by records, a record is a RECORD header (kind, microseconds since the session start, length)
+#and the bytes received from (KIND_IN) or sent to (KIND_OUT) the client
+MAGIC = b"EZBCAP\x01\x00"
+RECORD = struct.Struct("<BQI")
+KIND_IN = 0
+KIND_OUT = 1
+
+class EZBCapture:
+    """
+    Compact binary capture of an EZB session, written from the client's thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.start_time = time.monotonic()
+
+    def record(self, kind, data):
+        if self.file is None:
+            return
+        timestamp_us = int((time.monotonic() - self.start_time) * 1000000)
+        self.file.write(RECORD.pack(kind, timestamp_us, len(data)))
+        self.file.write(data)
+
+    def record_in(self, data):
+        self.record(KIND_IN, data)
+
+    def record_out(self, data):
+        self.record(KIND_OUT, data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def create(capture_dir, client_address):
+    #one capture file per client connection
+    os.makedirs(capture_dir, exist_ok=True)
+    name = "ezb-{}-{}.cap".format(datetime.datetime.now().strftime("%Y%m%d-%H%M%S"), client_address[1] if isinstance(client_address, tuple) else 0)
+    return EZBCapture(os.path.join(capture_dir, name))
+
+def read(path):
+    #yields (kind, timestamp in seconds, data)
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not an EZB capture file: {}".format(path))
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            kind, timestamp_us, data_len = RECORD.unpack(header)
+            data = f.read(data_len)
+            if len(data) < data_len:
+                break
+            yield (kind, timestamp_us / 1000000.0, data)
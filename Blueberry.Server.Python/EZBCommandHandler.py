@@ -0,0 +1,258 @@
+import os
+import ComponentRegistry
+import EZBProtocol
+import EZBProtocolDecoder
+
+class EZBCommandHandler:
+    """
+    Executes decoded EZB commands against the registered components.
+    Replies are appended to tx_buffer, the transport (thread or asyncio client) decides when to send them.
+    Subclasses provide self.logger.
+    """
+    EZB4V2_FIRMWARE_ID = 2
+    BLUEBERRY_FIRMWARE_ID = 18602
+
+    LAST_ANALOG_PORT = 7
+    LAST_DIGITAL_PORT = 23
+    SYS_THERMAL_ZONE = "/sys/class/thermal/thermal_zone0/temp"
+
+    def __init__(self):
+        self.ports = ComponentRegistry.ComponentRegistry.get_port_tables()
+        self.decoder = EZBProtocolDecoder.EZBProtocolDecoder()
+        self.dispatcher = self.create_dispatcher()
+        self.tx_buffer = bytearray()
+
+    def create_dispatcher(self):
+        cmd = EZBProtocol.CommandEnum
+        v4 = EZBProtocol.CommandV4Enum
+        snd = EZBProtocol.CommandSoundV4Enum
+        uart_stride = v4.UART1_INIT - v4.UART0_INIT
+        digital_ports = self.LAST_DIGITAL_PORT + 1
+        analog_ports = self.LAST_ANALOG_PORT + 1
+
+        dispatcher = EZBProtocolDecoder.EZBCommandDispatcher(self.on_unhandled)
+        dispatcher.register_v4(v4.SET_LIPO_BATTERY_PROTECTION_STATE, self.on_set_lipo_battery_protection_state)
+        dispatcher.register_v4(v4.SET_BATTERY_MONITOR_VOLTAGE, self.on_set_battery_monitor_voltage)
+        dispatcher.register_v4(v4.GET_BATTERY_VOLTAGE, self.on_get_battery_voltage)
+        dispatcher.register_v4(v4.GET_CPU_TEMPERATURE, self.on_get_cpu_temperature)
+        dispatcher.register_v4(v4.UART0_INIT, self.on_uart_init, EZBProtocolDecoder.UART_PORTS, uart_stride)
+        dispatcher.register_v4(v4.UART0_WRITE, self.on_uart_write, EZBProtocolDecoder.UART_PORTS, uart_stride)
+        dispatcher.register_v4(v4.UART0_AVAILABLE_BYTES, self.on_uart_available_bytes, EZBProtocolDecoder.UART_PORTS, uart_stride)
+        dispatcher.register_v4(v4.UART0_READ, self.on_uart_read, EZBProtocolDecoder.UART_PORTS, uart_stride)
+        dispatcher.register_v4(v4.SET_I2C_CLOCKSPEED, self.on_set_i2c_clockspeed)
+        dispatcher.register_v4(v4.SET_UART_CLOCKSPEED, self.on_set_uart_clockspeed)
+        dispatcher.register(cmd.I2C_WRITE, self.on_i2c_write)
+        dispatcher.register(cmd.I2C_READ, self.on_i2c_read)
+        dispatcher.register(cmd.SET_PWM_D0, self.on_set_pwm, digital_ports)
+        dispatcher.register(cmd.SET_SERVO_SPEED_D0, self.on_set_servo_speed, digital_ports)
+        dispatcher.register(cmd.PING, self.on_ping)
+        dispatcher.register(cmd.SET_DIGITAL_PORT_ON_D0, self.on_set_digital_port_on, digital_ports)
+        dispatcher.register(cmd.SET_DIGITAL_PORT_OFF_D0, self.on_set_digital_port_off, digital_ports)
+        dispatcher.register(cmd.GET_DIGITAL_PORT_D0, self.on_get_digital_port, digital_ports)
+        dispatcher.register(cmd.SET_SERVO_POSITION_D0, self.on_set_servo_position, digital_ports)
+        dispatcher.register(cmd.GET_ADC_VALUE_A0, self.on_get_adc_value, analog_ports)
+        dispatcher.register(cmd.SEND_SERIAL_D0, self.on_send_serial, digital_ports)
+        dispatcher.register(cmd.READ_HCSR04_D0, self.on_read_hcsr04, digital_ports)
+        dispatcher.register(cmd.GET_FIRMWARE_ID, self.on_get_firmware_id)
+        dispatcher.register_sound(snd.INIT_STOP, self.on_sound_init_stop)
+        dispatcher.register_sound(snd.LOAD, self.on_sound_load)
+        dispatcher.register_sound(snd.PLAY, self.on_sound_play)
+        return dispatcher
+
+    def execute(self, commands):
+        dispatch = self.dispatcher.dispatch
+        for command in commands:
+            dispatch(command)
+
+    def respond(self, data):
+        self.tx_buffer += data
+
+    def take_response(self):
+        data = bytes(self.tx_buffer)
+        self.tx_buffer.clear()
+        return data
+
+    def on_unhandled(self, command):
+        if command.code == EZBProtocol.CommandEnum.EZB4:
+            self.logger.warning("EZBProtocol.CommandV4Enum %s not handled", command.subcode)
+        elif command.code == EZBProtocol.CommandEnum.SOUND_STREAM_CMD:
+            self.logger.warning("CmdSoundStreamCmd %s not handled", command.subcode)
+        else:
+            self.logger.warning("cmd %s not handled", command.code)
+
+    def on_set_lipo_battery_protection_state(self, command):
+        self.logger.debug("EZBProtocol.CommandV4Enum.SET_LIPO_BATTERY_PROTECTION_STATE state=%s", command.args[0])
+
+    def on_set_battery_monitor_voltage(self, command):
+        bat_volt = command.args[0] / 258
+        self.logger.debug("EZBProtocol.CommandV4Enum.SET_BATTERY_MONITOR_VOLTAGE v=%s", bat_volt)
+
+    def on_get_battery_voltage(self, command):
+        self.logger.debug("EZBProtocol.CommandV4Enum.GET_BATTERY_VOLTAGE")
+        bat_volt = 258 * 5
+        self.respond(bat_volt.to_bytes(2, "little"))
+
+    def on_get_cpu_temperature(self, command):
+        self.logger.debug("EZBProtocol.CommandV4Enum.GET_CPU_TEMPERATURE")
+        if os.path.exists(self.SYS_THERMAL_ZONE):
+            f = open(self.SYS_THERMAL_ZONE)
+            cpu_temp = f.read()
+            f.close()
+        else:
+            cpu_temp = 37000
+        cpu_temp2 = int((int(cpu_temp) * 38.209699373057859) / 1000.0)
+        self.respond(cpu_temp2.to_bytes(2, "little"))
+
+    def on_uart_init(self, command):
+        bauds = command.args[0]
+        self.logger.debug("EZBProtocol.CommandV4Enum.UART%s_INIT bauds=%s", command.port, bauds)
+        com = self.ports.uarts[command.port]
+        if com is not None:
+            com.serial.baudrate = bauds
+
+    def on_uart_write(self, command):
+        self.logger.debug("EZBProtocol.CommandV4Enum.UART%s_WRITE len=%s", command.port, len(command.data))
+        com = self.ports.uarts[command.port]
+        if com is not None:
+            com.write(command.data)
+
+    def on_uart_available_bytes(self, command):
+        com = self.ports.uarts[command.port]
+        available_bytes = 0 if com is None else com.get_available_bytes()
+        self.logger.debug("EZBProtocol.CommandV4Enum.UART%s_AVAILABLE_BYTES => %s", command.port, available_bytes)
+        self.respond(available_bytes.to_bytes(2, "little"))
+
+    def on_uart_read(self, command):
+        data_len = command.args[0]
+        self.logger.debug("EZBProtocol.CommandV4Enum.UART%s_READ len=%s", command.port, data_len)
+        com = self.ports.uarts[command.port]
+        data = [] if com is None else com.read(data_len)
+        # bad protocol design!!! no way to send 0 bytes
+        if len(data)>0:
+            self.respond(data)
+
+    def on_set_i2c_clockspeed(self, command):
+        self.logger.debug("EZBProtocol.CommandV4Enum.SET_I2C_CLOCKSPEED speed=%s", command.args[0])
+
+    def on_set_uart_clockspeed(self, command):
+        baud_ix, timming = command.args
+        self.logger.debug("EZBProtocol.CommandV4Enum.SET_UART_CLOCKSPEED baud_ix=%s timming=%s", baud_ix, timming)
+
+    def on_i2c_write(self, command):
+        i2c_addr = command.args[0] >> 1
+        data_len = command.args[1]
+        self.logger.debug("EZBProtocol.CommandEnum.I2C_WRITE addr=%s/%s len=%s", i2c_addr, hex(i2c_addr), data_len)
+        i2c = ComponentRegistry.ComponentRegistry.get_component("i2c")
+        if i2c is not None:
+            i2c.write(i2c_addr, command.data)
+
+    def on_i2c_read(self, command):
+        i2c_addr = command.args[0] >> 1
+        data_len = command.args[1]
+        self.logger.debug("EZBProtocol.CommandEnum.I2C_READ addr=%s/%s len=%s", i2c_addr, hex(i2c_addr), data_len)
+        i2c = ComponentRegistry.ComponentRegistry.get_component("i2c")
+        if i2c is not None:
+            data = i2c.read(i2c_addr, data_len)
+        else:
+            data = bytes(0)
+
+        # bad protocol design!!! no way to send n bytes than requested
+        if len(data)<data_len:
+            #pad
+            data += bytearray(data_len - len(data))
+            self.logger.warning("padding requested=%s read=%s", data_len, len(data))
+        elif len(data)>data_len:
+            #truncate
+            data = data[0:data_len]
+        self.respond(data)
+
+    def on_set_pwm(self, command):
+        duty_cycle = command.args[0]
+        self.logger.debug("EZBProtocol.CommandEnum.SET_PWM port=%s duty_cycle=%s", command.port, duty_cycle)
+        pwm = self.ports.pwms[command.port]
+        if pwm is not None:
+            pwm.set_duty_cycle(duty_cycle)
+
+    def on_set_servo_speed(self, command):
+        speed = command.args[0]
+        self.logger.debug("EZBProtocol.CommandEnum.SET_SERVO_SPEED port=%s speed=%s", command.port, speed)
+        servo = self.ports.servos[command.port]
+        if servo is not None:
+            servo.set_speed(speed)
+
+    def on_ping(self, command):
+        self.logger.debug("EZBProtocol.CommandEnum.PING")
+        ping_response = 222
+        self.respond(ping_response.to_bytes(1, "little"))
+
+    def on_set_digital_port_on(self, command):
+        self.logger.debug("EZBProtocol.CommandEnum.SET_DIGITAL_PORT_ON port=%s", command.port)
+        digital = self.ports.digitals[command.port]
+        if digital is not None:
+            digital.set(1)
+
+    def on_set_digital_port_off(self, command):
+        self.logger.debug("EZBProtocol.CommandEnum.SET_DIGITAL_PORT_OFF port=%s", command.port)
+        digital = self.ports.digitals[command.port]
+        if digital is not None:
+            digital.set(0)
+
+    def on_get_digital_port(self, command):
+        self.logger.debug("EZBProtocol.CommandEnum.GET_DIGITAL_PORT port=%s", command.port)
+        digital = self.ports.digitals[command.port]
+        if digital is not None:
+            state = digital.get()
+        else:
+            state = 0
+        self.respond(state.to_bytes(1, "little"))
+
+    def on_set_servo_position(self, command):
+        position = command.args[0]
+        self.logger.debug("EZBProtocol.CommandEnum.SET_SERVO_POSITION port=%s position=%s", command.port, position)
+        servo = self.ports.servos[command.port]
+        if servo is not None:
+            #correct degrees 0-179
+            if position>0:
+                servo.set_position(position-1)
+            else:
+                servo.release()
+
+    def on_get_adc_value(self, command):
+        self.logger.debug("EZBProtocol.CommandEnum.GET_ADC_VALUE port=%s", command.port)
+        state = 0
+        self.respond(state.to_bytes(1, "little"))
+
+    def on_send_serial(self, command):
+        baud_ix, data_len = command.args
+        self.logger.debug("EZBProtocol.CommandEnum.SEND_SERIAL_D0 port=%s baud_ix=%s len=%s", command.port, baud_ix, data_len)
+        state = 0
+        self.respond(state.to_bytes(1, "little"))
+
+    def on_read_hcsr04(self, command):
+        echo_port = command.args[0]
+        self.logger.debug("EZBProtocol.CommandEnum.READ_HCSR04_D0 trigger_port=%s echo_port=%s", command.port, echo_port)
+        distance_value = 0
+        self.respond(distance_value.to_bytes(1, "little"))
+
+    def on_get_firmware_id(self, command):
+        self.logger.debug("EZBProtocol.CommandEnum.GET_FIRMWARE_ID")
+        self.respond(self.EZB4V2_FIRMWARE_ID.to_bytes(4, "little"))
+
+    def on_sound_init_stop(self, command):
+        self.logger.debug("EZBProtocol.CommandSoundV4Enum.INIT_STOP")
+        audio_player = ComponentRegistry.ComponentRegistry.get_component("audio_player")
+        if audio_player is not None:
+            audio_player.stream_stop()
+            audio_player.stream_init()
+
+    def on_sound_load(self, command):
+        self.logger.debug("EZBProtocol.CommandSoundV4Enum.LOAD len=%s", len(command.data))
+        audio_player = ComponentRegistry.ComponentRegistry.get_component("audio_player")
+        if audio_player is not None:
+            audio_player.stream_load(command.data)
+
+    def on_sound_play(self, command):
+        self.logger.debug("EZBProtocol.CommandSoundV4Enum.PLAY")
+        audio_player = ComponentRegistry.ComponentRegistry.get_component("audio_player")
+        if audio_player is not None:
+            audio_player.stream_play()
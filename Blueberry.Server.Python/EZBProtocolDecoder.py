@@ -0,0 +1,260 @@
+import struct
+import EZBProtocol
+
+DIGITAL_PORTS = 24
+ANALOG_PORTS = 8
+UART_PORTS = 3
+
+U8 = struct.Struct("<B")
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+U8_U8 = struct.Struct("<BB")
+U8_U16 = struct.Struct("<BH")
+
+class Layout:
+    """
+    Wire layout of a command after its opcode (and sub opcode).
+    header is a precompiled struct for the fixed fields (or None),
+    length_index points to the header field holding the payload length (or None).
+    sub_layouts is a 256 entries table when the opcode is followed by a sub opcode.
+    """
+    __slots__ = ("name", "port", "header", "length_index", "sub_layouts")
+
+    def __init__(self, name, port=0, header=None, length_index=None, sub_layouts=None):
+        self.name = name
+        self.port = port
+        self.header = header
+        self.length_index = length_index
+        self.sub_layouts = sub_layouts
+
+class EZBCommand:
+    __slots__ = ("code", "subcode", "port", "args", "data", "layout")
+
+    def __init__(self, code, subcode, port, args, data, layout):
+        self.code = code
+        self.subcode = subcode
+        self.port = port
+        self.args = args
+        self.data = data
+        self.layout = layout
+
+    def __repr__(self):
+        return "EZBCommand({} code={} subcode={} port={} args={} len={})".format(
+            self.layout.name, self.code, self.subcode, self.port, self.args, 0 if self.data is None else len(self.data))
+
+def _build_table(default_name):
+    return [Layout(default_name) for _ in range(256)]
+
+def _set_range(table, first, count, name, header=None, length_index=None):
+    for port in range(count):
+        table[first + port] = Layout(name, port, header, length_index)
+
+def _build_v4_layouts():
+    table = _build_table("EZB4_UNKNOWN")
+    v4 = EZBProtocol.CommandV4Enum
+    table[v4.SET_LIPO_BATTERY_PROTECTION_STATE] = Layout("SET_LIPO_BATTERY_PROTECTION_STATE", header=U8)
+    table[v4.SET_BATTERY_MONITOR_VOLTAGE] = Layout("SET_BATTERY_MONITOR_VOLTAGE", header=U16)
+    table[v4.GET_BATTERY_VOLTAGE] = Layout("GET_BATTERY_VOLTAGE")
+    table[v4.GET_CPU_TEMPERATURE] = Layout("GET_CPU_TEMPERATURE")
+    for port in range(UART_PORTS):
+        offset = port * (v4.UART1_INIT - v4.UART0_INIT)
+        table[v4.UART0_INIT + offset] = Layout("UART_INIT", port, U32)
+        table[v4.UART0_WRITE + offset] = Layout("UART_WRITE", port, U16, 0)
+        table[v4.UART0_AVAILABLE_BYTES + offset] = Layout("UART_AVAILABLE_BYTES", port)
+        table[v4.UART0_READ + offset] = Layout("UART_READ", port, U16)
+    table[v4.SET_I2C_CLOCKSPEED] = Layout("SET_I2C_CLOCKSPEED", header=U32)
+    table[v4.SET_UART_CLOCKSPEED] = Layout("SET_UART_CLOCKSPEED", header=U8_U16)
+    return table
+
+def _build_sound_layouts():
+    table = _build_table("SOUND_UNKNOWN")
+    snd = EZBProtocol.CommandSoundV4Enum
+    table[snd.INIT_STOP] = Layout("SOUND_INIT_STOP")
+    table[snd.LOAD] = Layout("SOUND_LOAD", header=U16, length_index=0)
+    table[snd.PLAY] = Layout("SOUND_PLAY")
+    return table
+
+def _build_layouts():
+    table = _build_table("UNKNOWN")
+    cmd = EZBProtocol.CommandEnum
+    table[cmd.EZB4] = Layout("EZB4", sub_layouts=_build_v4_layouts())
+    table[cmd.I2C_WRITE] = Layout("I2C_WRITE", header=U8_U8, length_index=1)
+    table[cmd.I2C_READ] = Layout("I2C_READ", header=U8_U8)
+    _set_range(table, cmd.SET_PWM_D0, DIGITAL_PORTS, "SET_PWM", U8)
+    _set_range(table, cmd.SET_SERVO_SPEED_D0, DIGITAL_PORTS, "SET_SERVO_SPEED", U8)
+    table[cmd.PING] = Layout("PING")
+    _set_range(table, cmd.SET_DIGITAL_PORT_ON_D0, DIGITAL_PORTS, "SET_DIGITAL_PORT_ON")
+    _set_range(table, cmd.SET_DIGITAL_PORT_OFF_D0, DIGITAL_PORTS, "SET_DIGITAL_PORT_OFF")
+    _set_range(table, cmd.GET_DIGITAL_PORT_D0, DIGITAL_PORTS, "GET_DIGITAL_PORT")
+    _set_range(table, cmd.SET_SERVO_POSITION_D0, DIGITAL_PORTS, "SET_SERVO_POSITION", U8)
+    _set_range(table, cmd.GET_ADC_VALUE_A0, ANALOG_PORTS, "GET_ADC_VALUE", U8)
+    _set_range(table, cmd.SEND_SERIAL_D0, DIGITAL_PORTS, "SEND_SERIAL", U8_U16, 1)
+    _set_range(table, cmd.READ_HCSR04_D0, DIGITAL_PORTS, "READ_HCSR04", U8)
+    table[cmd.GET_FIRMWARE_ID] = Layout("GET_FIRMWARE_ID")
+    table[cmd.SOUND_STREAM_CMD] = Layout("SOUND_STREAM_CMD", sub_layouts=_build_sound_layouts())
+    return table
+
+LAYOUTS = _build_layouts()
+
+class EZBProtocolDecoder:
+    """
+    Resumable EZB protocol decoder.
+    feed() accepts whatever bytes arrived (bytes, bytearray or memoryview), always consumes all of them
+    and returns the commands completed so far. Partial commands are kept until the next feed.
+    """
+    STATE_OPCODE = 0
+    STATE_SUBCODE = 1
+    STATE_HEADER = 2
+    STATE_PAYLOAD = 3
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._state = self.STATE_OPCODE
+        self._code = 0
+        self._subcode = 0
+        self._layout = None
+        self._args = ()
+        self._scratch = bytearray()
+        self._payload = None
+        self._payload_pos = 0
+        self.total_commands = 0
+
+    @property
+    def is_idle(self):
+        return self._state == self.STATE_OPCODE
+
+    def feed(self, data):
+        commands = []
+        view = memoryview(data)
+        size = len(view)
+        pos = 0
+        while pos < size:
+            state = self._state
+
+            if state == self.STATE_OPCODE:
+                code = view[pos]
+                pos += 1
+                self._code = code
+                self._subcode = 0
+                layout = LAYOUTS[code]
+                if layout.sub_layouts is not None:
+                    self._layout = layout
+                    self._state = self.STATE_SUBCODE
+                    continue
+
+            elif state == self.STATE_SUBCODE:
+                subcode = view[pos]
+                pos += 1
+                self._subcode = subcode
+                layout = self._layout.sub_layouts[subcode]
+
+            elif state == self.STATE_HEADER:
+                layout = self._layout
+                header = layout.header
+                need = header.size - len(self._scratch)
+                if need > size - pos:
+                    self._scratch += view[pos:size]
+                    pos = size
+                    continue
+                self._scratch += view[pos:pos + need]
+                pos += need
+                self._args = header.unpack(self._scratch)
+                self._scratch.clear()
+                if not self._begin_payload(layout):
+                    commands.append(self._complete(layout, None))
+                continue
+
+            else:
+                payload = self._payload
+                need = len(payload) - self._payload_pos
+                n = need if need <= size - pos else size - pos
+                payload[self._payload_pos:self._payload_pos + n] = view[pos:pos + n]
+                pos += n
+                self._payload_pos += n
+                if n == need:
+                    self._payload = None
+                    commands.append(self._complete(self._layout, payload))
+                continue
+
+            #opcode (or sub opcode) resolved, layout selected
+            header = layout.header
+            if header is None:
+                self._args = ()
+                commands.append(self._complete(layout, None))
+                continue
+
+            if header.size > size - pos:
+                #header split between feeds
+                self._layout = layout
+                self._state = self.STATE_HEADER
+                continue
+
+            self._args = header.unpack_from(view, pos)
+            pos += header.size
+            if layout.length_index is None:
+                commands.append(self._complete(layout, None))
+                continue
+
+            data_len = self._args[layout.length_index]
+            if data_len <= size - pos:
+                #fast path, payload fully available
+                data = view[pos:pos + data_len].tobytes()
+                pos += data_len
+                commands.append(self._complete(layout, data))
+                continue
+
+            self._begin_payload(layout)
+        return commands
+
+    def _begin_payload(self, layout):
+        if layout.length_index is None:
+            return False
+        data_len = self._args[layout.length_index]
+        if data_len == 0:
+            return False
+        self._layout = layout
+        self._payload = bytearray(data_len)
+        self._payload_pos = 0
+        self._state = self.STATE_PAYLOAD
+        return True
+
+    def _complete(self, layout, data):
+        if data is None and layout.length_index is not None:
+            data = bytes()
+        self._state = self.STATE_OPCODE
+        self.total_commands += 1
+        return EZBCommand(self._code, self._subcode, layout.port, self._args, data, layout)
+
+class EZBCommandDispatcher:
+    """
+    Sends decoded commands to their handlers using 256 entries opcode tables.
+    EZB4 and SOUND_STREAM_CMD commands are dispatched through a second table indexed by the sub opcode.
+    """
+    def __init__(self, unhandled):
+        self.handlers = [unhandled] * 256
+        self.v4_handlers = [unhandled] * 256
+        self.sound_handlers = [unhandled] * 256
+        self.handlers[EZBProtocol.CommandEnum.EZB4] = self._dispatch_v4
+        self.handlers[EZBProtocol.CommandEnum.SOUND_STREAM_CMD] = self._dispatch_sound
+
+    def register(self, code, handler, count=1):
+        for ix in range(code, code + count):
+            self.handlers[ix] = handler
+
+    def register_v4(self, subcode, handler, count=1, stride=1):
+        for ix in range(count):
+            self.v4_handlers[subcode + ix * stride] = handler
+
+    def register_sound(self, subcode, handler):
+        self.sound_handlers[subcode] = handler
+
+    def dispatch(self, command):
+        return self.handlers[command.code](command)
+
+    def _dispatch_v4(self, command):
+        return self.v4_handlers[command.subcode](command)
+
+    def _dispatch_sound(self, command):
+        return self.sound_handlers[command.subcode](command)
@@ -0,0 +1,110 @@
+import sys
+import threading
+import logging
+import time
+import socket
+import argparse
+import ComponentRegistry
+import DigitalController
+import ServoController
+import PWMController
+import FakeDigitalController
+import FakeI2CController
+import EZBTcpClient
+import EZBCapture
+
+class ReplayServer:
+    def __init__(self, log_level):
+        self.log_level = log_level
+        self.capture_dir = None
+
+    def unregister_client(self, client):
+        pass
+
+class ReplayEZBTcpClient(EZBTcpClient.EZBTcpClient):
+    #records the decode-to-dispatched latency of every command
+
+    def __init__(self, server, client_socket, client_address):
+        self.latencies = []
+        super().__init__(server, client_socket, client_address)
+
+    def execute(self, commands):
+        dispatch = self.dispatcher.dispatch
+        latencies = self.latencies
+        for command in commands:
+            start = time.perf_counter()
+            dispatch(command)
+            latencies.append(time.perf_counter() - start)
+
+def setup_fake_components(log_level):
+    #same port layout as Main.py on a non linux host, nothing touches real hardware
+    digital_com = FakeDigitalController.FakeDigitalController(log_level)
+    servo_com = ServoController.ServoController("FakeServoController", log_level)
+    pwm_com = PWMController.PWMController("FakePWMController", log_level)
+    for port in range(24):
+        ComponentRegistry.ComponentRegistry.register_component("D" + str(port), DigitalController.DigitalPort(digital_com, port))
+        ComponentRegistry.ComponentRegistry.register_component("S" + str(port), ServoController.ServoPort(servo_com, port, 560, 2140))
+        ComponentRegistry.ComponentRegistry.register_component("P" + str(port), PWMController.PWMPort(pwm_com, port))
+    ComponentRegistry.ComponentRegistry.register_component("i2c", FakeI2CController.FakeI2CController(log_level))
+
+def percentile(sorted_values, percent):
+    if len(sorted_values) == 0:
+        return 0
+    ix = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[ix]
+
+def drain(sock, received):
+    while True:
+        data = sock.recv(64 * 1024)
+        if len(data) == 0:
+            break
+        received[0] += len(data)
+
+def replay(path, realtime, log_level):
+    records = list(EZBCapture.read(path))
+    inbound = [(timestamp, data) for kind, timestamp, data in records if kind == EZBCapture.KIND_IN]
+    captured_out = sum(len(data) for kind, timestamp, data in records if kind == EZBCapture.KIND_OUT)
+
+    server_sock, replay_sock = socket.socketpair()
+    client = ReplayEZBTcpClient(ReplayServer(log_level), server_sock, ("replay", 0))
+    received = [0]
+    drain_thread = threading.Thread(target=drain, args=(replay_sock, received))
+    drain_thread.start()
+
+    start = time.perf_counter()
+    first_timestamp = inbound[0][0] if len(inbound) > 0 else 0
+    for timestamp, data in inbound:
+        if realtime:
+            delay = (timestamp - first_timestamp) - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        replay_sock.sendall(data)
+    #EOF ends the client's run thread once every command is executed
+    replay_sock.shutdown(socket.SHUT_WR)
+    client.run_thread.join()
+    elapsed = time.perf_counter() - start
+    drain_thread.join()
+    replay_sock.close()
+
+    latencies = sorted(client.latencies)
+    commands = len(latencies)
+    print("capture:   {} ({} records, {} bytes in)".format(path, len(records), sum(len(data) for timestamp, data in inbound)))
+    print("mode:      {}".format("realtime" if realtime else "max speed"))
+    print("commands:  {} in {:.3f}s => {:.0f} cmds/s".format(commands, elapsed, commands / elapsed if elapsed > 0 else 0))
+    print("latency:   p50={:.1f}us p99={:.1f}us max={:.1f}us".format(percentile(latencies, 50) * 1000000, percentile(latencies, 99) * 1000000, percentile(latencies, 100) * 1000000))
+    print("responses: {} bytes (captured {} bytes)".format(received[0], captured_out))
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays an EZB capture (Main.py --ezbcapture) against fake controllers")
+    parser.add_argument("capture", type=str, help="capture file")
+    parser.add_argument("--realtime", action='store_true', help="keep the captured timing instead of replaying as fast as possible (default: %(default)s)")
+    parser.add_argument("--debug", action='store_true', help="debug logging, slows the replay down (default: %(default)s)")
+    args = parser.parse_args()
+
+    log_level = logging.DEBUG if args.debug else logging.WARNING
+    logging.basicConfig(level=log_level, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    setup_fake_components(log_level)
+    replay(args.capture, args.realtime, log_level)
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,7 @@ import TcpServer
 import ComponentRegistry
 import Controller
 import EZBTcpClient
+import AsyncNetEngine
 
 class EZBTcpServerUdpBroadcaster(UdpBroadcaster.UdpBroadcaster):
     def __init__(self, server, delay, log_level):
@@ -21,14 +22,27 @@ class EZBTcpServerUdpBroadcaster(UdpBroadcaster.UdpBroadcaster):
 
 
 class EZBTcpServer(TcpServer.TcpServer):
-    def __init__(self, address, log_level):
+    def __init__(self, address, log_level, capture_dir=None):
         super().__init__("EZBTcpServer", address, log_level)
+        #capture_dir: every client session is recorded there (see EZBReplay)
+        self.capture_dir = capture_dir
 
     def get_client_instance(self, connection, client_address):
         return EZBTcpClient.EZBTcpClient(self, connection, client_address)
 
-def start(addr):
-    server = EZBTcpServer(addr, logging.DEBUG)
+class AsyncEZBTcpServer(AsyncNetEngine.AsyncTcpServer):
+    def __init__(self, engine, address, log_level, capture_dir=None):
+        super().__init__("AsyncEZBTcpServer", engine, address, log_level)
+        self.capture_dir = capture_dir
+
+    def get_client_instance(self):
+        return EZBTcpClient.AsyncEZBTcpClient(self)
+
+def start(addr, engine=None, capture_dir=None):
+    if engine is None:
+        server = EZBTcpServer(addr, logging.DEBUG, capture_dir)
+    else:
+        server = AsyncEZBTcpServer(engine, addr, logging.DEBUG, capture_dir)
     server.start()
     ComponentRegistry.ComponentRegistry.register_controller(server)
 
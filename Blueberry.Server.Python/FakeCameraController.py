@@ -10,20 +10,54 @@ import PIL.Image
 import PIL.ImageDraw
 
 class FakeCameraController(CameraController.CameraController):
-    def __init__(self, server, resolution, framerate, log_level):
+    """
+    Renders frame_count jpgs per size once at startup and cycles through them,
+    the capture loop costs almost nothing so benchmarks measure the servers.
+    entropy: fraction of the picture filled with random pixels (0..1), larger and less compressible jpgs.
+    stamp: inserts the frame counter as a jpg comment (COM segment) instead of drawing it.
+    """
+    #jpg start of image marker, the comment segment goes right after it
+    SOI = b"\xff\xd8"
+    COM = b"\xff\xfe"
+
+    def __init__(self, server, resolution, framerate, log_level, frame_count=30, sizes=None, entropy=0.0, stamp=False):
         super().__init__("FakeCameraController", server, resolution, framerate, log_level)
-        self.frame_rate_delay = 1 / framerate
+        self.frame_count = frame_count
+        self.sizes = sizes or [resolution]
+        self.entropy = entropy
+        self.stamp = stamp
+        self.frames = []
+
+    def setup(self):
+        start = time.monotonic()
+        self.frames = [self.render(size, ix) for size in self.sizes for ix in range(self.frame_count)]
+        self.logger.debug("rendered frames:%s sizes:%s bytes:%s in %.2fs",
+                          len(self.frames), self.sizes, sum(len(frame) for frame in self.frames), time.monotonic() - start)
+        return len(self.frames) > 0
+
+    def render(self, size, ix):
+        (width, height) = size
+        img = PIL.Image.new("RGB", size, color = (73, 109, 137))
+        rows = int(height * self.entropy)
+        if rows > 0:
+            noise = PIL.Image.frombytes("RGB", (width, rows), os.urandom(width * rows * 3))
+            img.paste(noise, (0, height - rows))
+        draw = PIL.ImageDraw.Draw(img)
+        draw.text((10,10), "Frame: {}/{} {}x{}".format(ix + 1, self.frame_count, width, height), fill=(255,255,0))
+        img_buffer = io.BytesIO()
+        img.save(img_buffer, format="JPEG", quality=100, subsampling=0)
+        return img_buffer.getvalue()
+
+    def stamp_frame(self, img_bytes, frame):
+        text = "Frame: {}".format(frame).encode()
+        return self.SOI + self.COM + (len(text) + 2).to_bytes(2, "big") + text + img_bytes[len(self.SOI):]
 
     def main(self):
         frame = 0
-        while not self.shutdown:
-            (width, height) = self.resolution
-            img = PIL.Image.new("RGB", self.resolution, color = (73, 109, 137))
-            draw = PIL.ImageDraw.Draw(img)
-            draw.text((10,10), "Frame: {}".format(frame), fill=(255,255,0))
+        while self.wait_for_viewers():
+            self.pace()
+            img_bytes = self.frames[frame % len(self.frames)]
+            if self.stamp:
+                img_bytes = self.stamp_frame(img_bytes, frame)
             frame += 1
-            img_buffer = io.BytesIO()
-            img.save(img_buffer, format="JPEG", quality=100, subsampling=0)
-            img_bytes = img_buffer.getvalue() 
             self.send_image(img_bytes)
-            time.sleep(self.frame_rate_delay)
@@ -17,12 +17,15 @@ class FakeI2CSlave(I2CController.I2CSlave):
         super().close()
 
     def write(self, data):
+        self.invalidate_shadow(data)
         try:
             self.logger.debug("write: dec=%s hex=%s", list(data), [hex(x) for x in list(data)])
         except Exception as ex:
             self.logger.error("writing: ex=%s", ex)
+        return True
 
     def read(self, bytes_to_read):
+        self.invalidate_shadow()
         data = bytearray(bytes_to_read)
         self.logger.debug("read: bytes_to_read:%s => data:%s", bytes_to_read, data)
         return data
@@ -40,3 +43,12 @@ class FakeI2CController(I2CController.I2CController):
     def create_slave(self, i2c_addr):
         return FakeI2CSlave(self, i2c_addr)
 
+    def transfer(self, messages):
+        self.invalidate_shadows(messages)
+        for message in messages:
+            if message.is_read:
+                message.data = bytearray(message.length)
+                self.logger.debug("transfer: read addr=%s bytes_to_read:%s => data:%s", message.i2c_addr, message.length, message.data)
+            else:
+                self.logger.debug("transfer: write addr=%s dec=%s hex=%s", message.i2c_addr, list(message.data), [hex(x) for x in message.data])
+
@@ -0,0 +1,140 @@
+import threading
+import logging
+import time
+import datetime
+import collections
+import Controller
+
+class FramePipeline(Controller.Controller):
+    """
+    Capture -> encode -> send stages, each on its own thread(s).
+    The capture thread submits raw frames, a pool of encode workers turns them into jpg bytes (cv2 releases the GIL)
+    and a single send thread delivers them in frame order.
+    Stale frames are dropped between the stages: when every worker is busy the oldest waiting raw frame is replaced,
+    and when the sender falls behind only the newest encoded frame is sent.
+    """
+    DEBUG_INTERVAL = 5 * 60 # 5 minutes
+
+    def __init__(self, name, encode, send, log_level, workers=2, max_pending=None):
+        super().__init__(name, log_level)
+        self.encode = encode
+        self.send = send
+        self.workers = workers
+        #raw frames waiting for a worker
+        self.max_pending = max_pending or workers
+        self.condition = threading.Condition()
+        self.pending = collections.deque()
+        #sequence => jpg bytes (None when dropped or the encode failed)
+        self.done = dict()
+        self.next_seq = 0
+        self.send_seq = 0
+        self.shutdown = True
+        self.threads = []
+        self.total_submitted = 0
+        self.total_sent = 0
+        self.total_dropped_capture = 0
+        self.total_dropped_send = 0
+        self.total_failed = 0
+
+    def start(self):
+        self.logger.debug("starting workers=%s max_pending=%s", self.workers, self.max_pending)
+        self.shutdown = False
+        self.threads = [threading.Thread(target=self.run_encode, name="{}-encode-{}".format(self.name, ix)) for ix in range(self.workers)]
+        self.threads.append(threading.Thread(target=self.run_send, name="{}-send".format(self.name)))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        if self.shutdown:
+            self.logger.warning("Already stopped")
+            return
+
+        self.logger.debug("stopping")
+        self.condition.acquire()
+        try:
+            self.shutdown = True
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+        for thread in self.threads:
+            self.logger.debug("join th:%s", thread.getName())
+            thread.join()
+        self.threads = []
+
+    def submit(self, frame):
+        #capture thread, never blocks
+        self.condition.acquire()
+        try:
+            if len(self.pending) >= self.max_pending:
+                seq, stale = self.pending.popleft()
+                self.done[seq] = None
+                self.total_dropped_capture += 1
+            self.pending.append((self.next_seq, frame))
+            self.next_seq += 1
+            self.total_submitted += 1
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def run_encode(self):
+        self.logger.debug("running thread:%s", threading.current_thread().getName())
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.shutdown and len(self.pending) == 0:
+                    self.condition.wait()
+                if self.shutdown:
+                    break
+                seq, frame = self.pending.popleft()
+            finally:
+                self.condition.release()
+
+            try:
+                data = self.encode(frame)
+            except Exception as ex:
+                self.logger.error("encode ex=%s", ex)
+                data = None
+
+            self.condition.acquire()
+            try:
+                if data is None:
+                    self.total_failed += 1
+                self.done[seq] = data
+                self.condition.notify_all()
+            finally:
+                self.condition.release()
+        self.logger.debug("terminated")
+
+    def run_send(self):
+        self.logger.debug("running thread:%s", threading.current_thread().getName())
+        last_debug_dt = None
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.shutdown and self.send_seq not in self.done:
+                    self.condition.wait()
+                if self.shutdown:
+                    break
+                #sender behind the encoders: skip to the newest consecutive encoded frame
+                while self.send_seq + 1 in self.done and len(self.done) > self.workers:
+                    if self.done.pop(self.send_seq) is not None:
+                        self.total_dropped_send += 1
+                    self.send_seq += 1
+                data = self.done.pop(self.send_seq)
+                self.send_seq += 1
+            finally:
+                self.condition.release()
+
+            if data is not None:
+                try:
+                    self.send(data)
+                    self.total_sent += 1
+                except Exception as ex:
+                    self.logger.error("send ex=%s", ex)
+
+            ds = 1917 if last_debug_dt is None else (datetime.datetime.now()-last_debug_dt).total_seconds()
+            if ds>=self.DEBUG_INTERVAL:
+                self.logger.debug("run submitted:%s sent:%s dropped capture:%s dropped send:%s failed:%s",
+                                  self.total_submitted, self.total_sent, self.total_dropped_capture, self.total_dropped_send, self.total_failed)
+                last_debug_dt = datetime.datetime.now()
+        self.logger.debug("terminated")
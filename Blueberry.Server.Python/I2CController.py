@@ -2,10 +2,41 @@ import logging
 import threading
 import Controller
 
+class RegisterShadow:
+    """
+    Write-through copy of the registers written by the driver.
+    Volatile registers (status, triggers, ...) are never cached.
+    write_one_to_clear maps a register to the bits the chip clears by itself once written (e.g. PCA9685 RESTART).
+    """
+    def __init__(self, volatile_registers=(), write_one_to_clear=None):
+        self.values = dict()
+        self.volatile = frozenset(volatile_registers)
+        self.write_one_to_clear = dict() if write_one_to_clear is None else write_one_to_clear
+        self.total_skipped_writes = 0
+        self.total_cached_reads = 0
+
+    def get(self, reg_u8):
+        if reg_u8 in self.volatile:
+            return None
+        return self.values.get(reg_u8)
+
+    def record(self, reg_u8, data_u8):
+        if reg_u8 not in self.volatile:
+            self.values[reg_u8] = data_u8 & ~self.write_one_to_clear.get(reg_u8, 0)
+
+    def invalidate(self, reg_u8=None):
+        if reg_u8 is None:
+            self.values.clear()
+        else:
+            self.values.pop(reg_u8, None)
+
+
 class I2CSlave:
     def __init__(self, controller, i2c_addr):
         self.controller = controller
         self.i2c_addr = i2c_addr
+        #opt-in, see enable_shadow
+        self.shadow = None
         self.logger = logging.getLogger("{}-{}".format(controller.name, i2c_addr))
         self.logger.setLevel(controller.log_level)
 
@@ -16,7 +47,8 @@ class I2CSlave:
         self.controller.remove_slave(self)
 
     def write(self, data):
-        pass
+        #returns False when the write failed
+        return True
 
     def read(self, bytes_to_read):
         return None
@@ -24,23 +56,112 @@ class I2CSlave:
     def write_read_data(self, byte_to_write, bytes_to_read):
         return None
 
+    def enable_shadow(self, volatile_registers=(), write_one_to_clear=None):
+        #only the *_reg_* helpers use the shadow, raw write()/read() calls invalidate it (see invalidate_shadow)
+        self.shadow = RegisterShadow(volatile_registers, write_one_to_clear)
+
+    def invalidate_shadow(self, data=None):
+        #raw write: data[0] is the first register, auto-increment (AI) covers the rest
+        #raw read (data=None): the register pointer is unknown, the whole shadow is dropped
+        shadow = self.shadow
+        if shadow is None:
+            return
+        if data is None:
+            shadow.invalidate()
+            return
+        for reg_u8 in range(data[0], data[0] + len(data) - 1):
+            shadow.invalidate(reg_u8)
+
     def write_reg_byte(self, reg_u8, data_u8):
+        shadow = self.shadow
+        if shadow is not None:
+            if shadow.get(reg_u8) == data_u8:
+                shadow.total_skipped_writes += 1
+                return
         data = bytearray(2)
         data[0] = reg_u8
         data[1] = data_u8
-        self.write(data)
+        ok = self.write(data)
+        if shadow is not None:
+            #a failed write leaves the register unknown, the next write must reach the bus
+            if ok:
+                shadow.record(reg_u8, data_u8)
+            else:
+                shadow.invalidate(reg_u8)
 
     def write_reg_word(self, reg_u8, data_u16):
         data = bytearray()
         data.append(reg_u8)
         data += data_u16.to_bytes(2, "little")
-        self.write(data)
+        shadow = self.shadow
+        if shadow is not None:
+            if shadow.get(reg_u8) == data[1] and shadow.get(reg_u8 + 1) == data[2]:
+                shadow.total_skipped_writes += 1
+                return
+        ok = self.write(data)
+        if shadow is not None:
+            if ok:
+                shadow.record(reg_u8, data[1])
+                shadow.record(reg_u8 + 1, data[2])
+            else:
+                shadow.invalidate(reg_u8)
+                shadow.invalidate(reg_u8 + 1)
 
     def read_reg_byte(self, reg_u8):
+        shadow = self.shadow
+        if shadow is not None:
+            value = shadow.get(reg_u8)
+            if value is not None:
+                shadow.total_cached_reads += 1
+                return value
         data = self.write_read_data(reg_u8, 1)
+        if shadow is not None:
+            shadow.record(reg_u8, data[0])
         return data[0]
 
 
+class I2CMessage:
+    __slots__ = ("i2c_addr", "is_read", "length", "data")
+
+    def __init__(self, i2c_addr, is_read, length, data=None):
+        self.i2c_addr = i2c_addr
+        self.is_read = is_read
+        self.length = length
+        #read messages are filled by the transfer
+        self.data = data
+
+
+class I2CTransaction:
+    """
+    Queues writes and reads (possibly to several addresses) and submits them as a single combined transfer.
+    read() returns the message, its data is available after submit().
+    """
+    def __init__(self, controller):
+        self.controller = controller
+        self.messages = []
+
+    def write(self, i2c_addr, data):
+        data = bytes(data)
+        self.messages.append(I2CMessage(i2c_addr, False, len(data), data))
+        return self
+
+    def write_reg_byte(self, i2c_addr, reg_u8, data_u8):
+        return self.write(i2c_addr, (reg_u8, data_u8))
+
+    def read(self, i2c_addr, bytes_to_read):
+        message = I2CMessage(i2c_addr, True, bytes_to_read)
+        self.messages.append(message)
+        return message
+
+    def submit(self):
+        #returns the data of the read messages (in order)
+        messages = self.messages
+        self.messages = []
+        if len(messages) > 0:
+            self.controller.transfer(messages)
+        return [message.data for message in messages if message.is_read]
+
+
 class I2CController(Controller.Controller):
     def __init__(self, name, log_level):
         self.name = name
@@ -54,6 +175,11 @@ class I2CController(Controller.Controller):
         return None
 
     def get_slave(self, i2c_addr):
+        #cached slaves are returned without taking the lock (dict reads are atomic)
+        slave = self.slaves.get(i2c_addr)
+        if slave is not None:
+            return slave
+
         self.lock.acquire()
         try:
             if i2c_addr not in self.slaves:
@@ -69,7 +195,7 @@ class I2CController(Controller.Controller):
     def remove_slave(self, slave):
         self.lock.acquire()
         try:
-            if slave.i2c_addr in self.slaves:
+            if self.slaves.get(slave.i2c_addr) is slave:
                 self.slaves.pop(slave.i2c_addr)
                 self.logger.debug("removed slave:%s #:%s", slave.i2c_addr, len(self.slaves))
         finally:
@@ -89,15 +215,34 @@ class I2CController(Controller.Controller):
             return bytes()
         return slave.read(bytes_to_read)
 
+    def transaction(self):
+        return I2CTransaction(self)
+
+    def invalidate_shadows(self, messages):
+        #transfers bypass the slaves, their shadows must forget the written registers
+        for message in messages:
+            if not message.is_read:
+                slave = self.slaves.get(message.i2c_addr)
+                if slave is not None:
+                    slave.invalidate_shadow(message.data)
+
+    def transfer(self, messages):
+        #controllers without combined transfers execute the messages one by one
+        for message in messages:
+            if message.is_read:
+                message.data = self.read(message.i2c_addr, message.length)
+            else:
+                self.write(message.i2c_addr, message.data)
+
     def stop(self):
         self.lock.acquire()
         try:
             slaves = self.slaves.copy()
-
-            for i2c_addr in slaves:
-                self.logger.debug("closing slave=%s", i2c_addr)
-                slaves[i2c_addr].close()
-
             self.slaves = dict()
         finally:
             self.lock.release()
+
+        #closing calls remove_slave, the lock must not be held
+        for i2c_addr in slaves:
+            self.logger.debug("closing slave=%s", i2c_addr)
+            slaves[i2c_addr].close()
@@ -0,0 +1,94 @@
+import threading
+import logging
+import EZBCameraServer
+
+class MJPEGHttpClient(EZBCameraServer.EZBCameraTcpClient):
+    """
+    GET / or /stream.mjpg: multipart/x-mixed-replace stream of the camera's jpgs.
+    GET /snapshot.jpg: the last jpg.
+    Frames go through the viewer's own queue and sender thread, exactly like an EZB camera viewer.
+    """
+    MAX_REQUEST_SIZE = 8 * 1024
+    BOUNDARY = "frame"
+    STREAM_PATHS = ("/", "/stream.mjpg")
+    SNAPSHOT_PATH = "/snapshot.jpg"
+    STREAM_HEADER = ("HTTP/1.0 200 OK\r\n"
+                     "Content-Type: multipart/x-mixed-replace; boundary=" + BOUNDARY + "\r\n"
+                     "Cache-Control: no-cache\r\n"
+                     "Pragma: no-cache\r\n"
+                     "Connection: close\r\n\r\n").encode()
+    PART_HEADER = "--" + BOUNDARY + "\r\nContent-Type: image/jpeg\r\nContent-Length: {}\r\n\r\n"
+    PART_END = b"\r\n"
+    SNAPSHOT_HEADER = ("HTTP/1.0 200 OK\r\n"
+                       "Content-Type: image/jpeg\r\n"
+                       "Content-Length: {}\r\n"
+                       "Cache-Control: no-cache\r\n"
+                       "Connection: close\r\n\r\n")
+
+    def __init__(self, server, client_socket, client_address, max_queued_frames=2, max_fps=0):
+        #frames are ignored until the stream is requested
+        self.streaming = False
+        super().__init__(server, client_socket, client_address, max_queued_frames, max_fps, "MJPEGHttpClient")
+
+    def queue_frame(self, frame):
+        if self.streaming:
+            super().queue_frame(frame)
+
+    def send_frame(self, frame):
+        jpg = frame[1]
+        return self.send_buffers((self.PART_HEADER.format(len(jpg)).encode(), jpg, self.PART_END))
+
+    def read_request(self):
+        #returns the request path or None
+        request = bytearray()
+        while b"\r\n\r\n" not in request:
+            if len(request) > self.MAX_REQUEST_SIZE:
+                return None
+            data = self.recv_available()
+            if data is None:
+                return None
+            request += data
+        fields = bytes(request).split(b"\r\n", 1)[0].split()
+        if len(fields) < 2 or fields[0] != b"GET":
+            return None
+        return fields[1].decode("latin-1").split("?", 1)[0]
+
+    def send_error(self, status):
+        self.send_all("HTTP/1.0 {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".format(status).encode())
+
+    def main(self):
+        path = self.read_request()
+        self.logger.debug("request path:%s", path)
+        if path is None:
+            self.send_error("400 Bad Request")
+            return
+
+        last_frame = self.server.last_frame
+        if path == self.SNAPSHOT_PATH:
+            if last_frame is None:
+                self.send_error("503 Service Unavailable")
+                return
+            jpg = last_frame[1]
+            self.send_buffers((self.SNAPSHOT_HEADER.format(len(jpg)).encode(), jpg))
+            return
+
+        if path not in self.STREAM_PATHS:
+            self.send_error("404 Not Found")
+            return
+
+        if not self.send_all(self.STREAM_HEADER):
+            return
+        self.streaming = True
+        if last_frame is not None:
+            self.queue_frame(last_frame)
+        #the sender thread streams, this one waits for the viewer to disconnect
+        while not self.shutdown:
+            if self.recv_available() is None:
+                break
+
+class MJPEGHttpServer(EZBCameraServer.EZBCameraTcpServer):
+    def __init__(self, address, log_level, max_queued_frames=2, max_client_fps=0):
+        super().__init__(address, log_level, max_queued_frames, max_client_fps, "MJPEGHttpServer")
+
+    def get_client_instance(self, connection, client_address):
+        return MJPEGHttpClient(self, connection, client_address, self.max_queued_frames, self.max_client_fps)
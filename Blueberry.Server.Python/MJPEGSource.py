@@ -0,0 +1,103 @@
+import logging
+import cv2
+
+#jpg start and end of image markers
+SOI = b"\xff\xd8"
+EOI = b"\xff\xd9"
+#uvc cameras may pad the buffer after the end of image marker
+MAX_PADDING = 32
+
+def trim_jpg(data):
+    #returns data without the padding after EOI or None when SOI/EOI are missing (truncated frame)
+    if len(data) < len(SOI) + len(EOI) or data[:len(SOI)] != SOI:
+        return None
+    if data[-len(EOI):] == EOI:
+        return data
+    end = bytes(data[-MAX_PADDING:]).rfind(EOI)
+    if end < 0:
+        return None
+    return data[:len(data) - min(MAX_PADDING, len(data)) + end + len(EOI)]
+
+class V4L2MJPEGSource:
+    """
+    Compressed frames straight from the device (MJPG fourcc), OpenCV neither decodes nor converts them.
+    """
+
+    def __init__(self, video_capture, logger):
+        self.video_capture = video_capture
+        self.logger = logger
+        self.total_invalid = 0
+
+    def open(self):
+        #call before setting the resolution, most webcams only reach their higher resolutions/fps in MJPG
+        #returns False when the device (or OpenCV's backend) can't deliver the raw MJPG buffers
+        fourcc = cv2.VideoWriter_fourcc(*"MJPG")
+        self.video_capture.set(cv2.CAP_PROP_FOURCC, fourcc)
+        if int(self.video_capture.get(cv2.CAP_PROP_FOURCC)) != fourcc:
+            self.logger.info("MJPG not supported")
+            return False
+        self.video_capture.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        return True
+
+    def probe(self):
+        #the raw buffer is a single row, a decoded frame means the backend ignored CONVERT_RGB
+        ret, buf = self.video_capture.read()
+        if not ret or buf.ndim != 2 or buf.shape[0] != 1:
+            self.logger.info("raw MJPG frames not available")
+            self.video_capture.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+            return False
+        return True
+
+    def read_jpg(self):
+        #returns the jpg bytes or None
+        ret, buf = self.video_capture.read()
+        if not ret:
+            return None
+        jpg = trim_jpg(buf.tobytes())
+        if jpg is None:
+            self.total_invalid += 1
+            self.logger.debug("invalid jpg len=%s #invalid:%s", buf.size, self.total_invalid)
+        return jpg
+
+    def release(self):
+        self.video_capture.release()
+
+class MJPEGFileSource:
+    """
+    Frames from a file of concatenated jpgs (e.g. ffmpeg -f mjpeg, or cat *.jpg), replayed in a loop.
+    Frames are split on SOI/EOI markers, jpgs with embedded (exif) thumbnails are not supported.
+    """
+
+    def __init__(self, path, logger, loop=True):
+        self.path = path
+        self.logger = logger
+        self.loop = loop
+        self.frames = []
+        self.index = 0
+        self.total_invalid = 0
+
+    def open(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        start = data.find(SOI)
+        while start >= 0:
+            end = data.find(EOI, start + len(SOI))
+            if end < 0:
+                self.total_invalid += 1
+                break
+            self.frames.append(data[start:end + len(EOI)])
+            start = data.find(SOI, end + len(EOI))
+        self.logger.debug("file:%s frames:%s invalid:%s", self.path, len(self.frames), self.total_invalid)
+        return len(self.frames) > 0
+
+    def read_jpg(self):
+        if self.index >= len(self.frames):
+            if not self.loop:
+                return None
+            self.index = 0
+        jpg = self.frames[self.index]
+        self.index += 1
+        return jpg
+
+    def release(self):
+        self.frames = []
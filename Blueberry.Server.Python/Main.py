@@ -32,10 +32,10 @@ import ComponentRegistry
 import EZBTcpServer
 import EZBCameraServer
 
-def setup_i2c():
+def setup_i2c(shared_fd):
     if sys.platform == "linux" or sys.platform == "linux2":
         import DeviceI2CController
-        com = DeviceI2CController.DeviceI2CController(1, logging.DEBUG)
+        com = DeviceI2CController.DeviceI2CController(1, logging.DEBUG, shared_fd)
     else:
         import FakeI2CController
         com = FakeI2CController.FakeI2CController(logging.DEBUG)
@@ -97,45 +97,59 @@ def setup_digital_ports():
             ComponentRegistry.ComponentRegistry.register_component("D" + str(port),  DigitalController.DigitalPort(com, port))
         com.start()
 
-def setup_i2c_PCA9685Controller(i2c_com, freq=490):
+def setup_ActuatorBus(com, actuator_tick):
+    #ports post to the bus, a single writer thread flushes to the controller
+    if actuator_tick <= 0:
+        return com
+    import ActuatorBus
+    bus = ActuatorBus.ActuatorBus(com, logging.DEBUG, actuator_tick)
+    ComponentRegistry.ComponentRegistry.register_controller(bus)
+    bus.start()
+    return bus
+
+def setup_i2c_PCA9685Controller(i2c_com, actuator_tick, shadow_registers, freq=490):
     import PCA9685Controller
-    com = PCA9685Controller.PCA9685Controller(i2c_com, logging.DEBUG)
+    com = PCA9685Controller.PCA9685Controller(i2c_com, logging.DEBUG, shadow_registers=shadow_registers)
     ComponentRegistry.ComponentRegistry.register_controller(com)
+    bus = setup_ActuatorBus(com, actuator_tick)
     for port in range(16):
-        ComponentRegistry.ComponentRegistry.register_component("P"+str(port), PWMController.PWMPort(com, port))
+        ComponentRegistry.ComponentRegistry.register_component("P"+str(port), PWMController.PWMPort(bus, port))
     com.start()
     com.frequency = freq
 
-def setup_i2c_PCA9685ServoController(i2c_com):
+def setup_i2c_PCA9685ServoController(i2c_com, actuator_tick, shadow_registers):
     import PCA9685Controller
-    com = PCA9685Controller.PCA9685ServoController(i2c_com, logging.DEBUG)
+    com = PCA9685Controller.PCA9685ServoController(i2c_com, logging.DEBUG, shadow_registers=shadow_registers)
     ComponentRegistry.ComponentRegistry.register_controller(com)
+    bus = setup_ActuatorBus(com, actuator_tick)
     for port in range(16):
-        ComponentRegistry.ComponentRegistry.register_component("S"+str(port), ServoController.ServoPort(com, port, 560, 2140))
+        ComponentRegistry.ComponentRegistry.register_component("S"+str(port), ServoController.ServoPort(bus, port, 560, 2140))
     #bear in mind pwm ports frequency is 50 hz used for servos (frequency is per controller) 
     for port in range(16):
-        ComponentRegistry.ComponentRegistry.register_component("P"+str(port), PWMController.PWMPort(com, port))
+        ComponentRegistry.ComponentRegistry.register_component("P"+str(port), PWMController.PWMPort(bus, port))
     com.start()
 
-def setup_i2c_PimoroniPanTiltHatServoController(i2c_com):
+def setup_i2c_PimoroniPanTiltHatServoController(i2c_com, actuator_tick, shadow_registers):
     import PimoroniPanTiltHatServoController
-    com = PimoroniPanTiltHatServoController.PimoroniPanTiltHatServoController(i2c_com, logging.DEBUG)
+    com = PimoroniPanTiltHatServoController.PimoroniPanTiltHatServoController(i2c_com, logging.DEBUG, shadow_registers=shadow_registers)
     ComponentRegistry.ComponentRegistry.register_controller(com)
+    bus = setup_ActuatorBus(com, actuator_tick)
     for port in range(2):
-        ComponentRegistry.ComponentRegistry.register_component("S"+str(port), ServoController.ServoPort(com, port, 575, 2325))    
+        ComponentRegistry.ComponentRegistry.register_component("S"+str(port), ServoController.ServoPort(bus, port, 575, 2325))    
     com.start()
 
-def setup_serial_MaestroServoController(serial_port_name):
+def setup_serial_MaestroServoController(serial_port_name, actuator_tick):
     import MaestroServoController
     com = MaestroServoController.MaestroServoController(serial_port_name, logging.DEBUG)
     ComponentRegistry.ComponentRegistry.register_controller(com)
+    bus = setup_ActuatorBus(com, actuator_tick)
     for port in range(24):
         #ez-robot servos: 560-2140 us
-        ComponentRegistry.ComponentRegistry.register_component("S"+str(port), ServoController.ServoPort(com, port, 560, 2140))
+        ComponentRegistry.ComponentRegistry.register_component("S"+str(port), ServoController.ServoPort(bus, port, 560, 2140))
     com.start()
 
-def setup_SerialPortController(component_name, device_name, baud_rate):
-    com = SerialPortController.SerialPortController(device_name, baud_rate, logging.DEBUG)
+def setup_SerialPortController(component_name, device_name, baud_rate, rx_capacity, overflow):
+    com = SerialPortController.SerialPortController(device_name, baud_rate, logging.DEBUG, rx_capacity, overflow)
     ComponentRegistry.ComponentRegistry.register_component(component_name, com)
     ComponentRegistry.ComponentRegistry.register_controller(com)
     com.start()
@@ -158,6 +172,7 @@ def main():
     parser.add_argument("--ezbport", type=int, default=10023, help="EZB Server TCP port (default: %(default)s)")
     parser.add_argument("--camaddr", type=str, default="0.0.0.0", help="Camera Server IP Address (default: %(default)s)")
     parser.add_argument("--camport", type=int, default=10024, help="Camera Server TCP Port (default: %(default)s)")
+    parser.add_argument("--camhttpport", type=int, default=None, help="Camera HTTP port for MJPEG viewers (/ and /snapshot.jpg) (default: %(default)s)")
     parser.add_argument("--camwidth", type=int, default=640, help="Camera Video's Width (default: %(default)s)")
     parser.add_argument("--camheight", type=int, default=480, help="Camera Video's Height (default: %(default)s)")
     parser.add_argument("--camfps", type=int, default=15, help="Camera Video's frames per second (default: %(default)s)")
@@ -169,6 +184,17 @@ def main():
                     choices=["none", "horizontal", "vertical", "both"],
                     help="(default: %(default)s)")
     parser.add_argument("--jpgquality", type=int, default=95, help="Jpeg's quality (0-100) (default: %(default)s)")
+    parser.add_argument("--camencodeworkers", type=int, default=2, help="videocapture jpg encoder threads, 0=capture and encode in sequence (default: %(default)s)")
+    parser.add_argument("--camclientqueue", type=int, default=2, help="frames queued per camera viewer, older frames are dropped for slow viewers (default: %(default)s)")
+    parser.add_argument("--camclientfps", type=int, default=0, help="frames per second cap per camera viewer, 0=no cap (default: %(default)s)")
+    parser.add_argument("--camadaptive", action='store_true', help="videocapture: lower jpg quality and then resolution when viewers can't keep up with --camfps (default: %(default)s)")
+    parser.add_argument("--jpgminquality", type=int, default=40, help="--camadaptive lowest jpg quality (default: %(default)s)")
+    parser.add_argument("--camminscale", type=float, default=0.5, help="--camadaptive lowest resolution scale (default: %(default)s)")
+    parser.add_argument("--camondemand", action='store_true', help="capture only while camera viewers are connected (default: %(default)s)")
+    parser.add_argument("--camlinger", type=float, default=5.0, help="--camondemand seconds to keep capturing after the last viewer leaves (default: %(default)s)")
+    parser.add_argument("--camwarmup", type=float, default=0.5, help="--camondemand seconds of frames discarded when capture resumes (default: %(default)s)")
+    parser.add_argument("--cammotion", type=float, default=0, help="videocapture: skip frames whose mean pixel difference (0-255) from the last frame sent is below this, 0=off (default: %(default)s)")
+    parser.add_argument("--cammotionkeepalive", type=float, default=1.0, help="--cammotion: send a frame at least every N seconds, 0=never (default: %(default)s)")
     parser.add_argument("--audio", action='store_true', help="enable audio output (default: %(default)s)")
     parser.add_argument("--audiooutputindex", type=int, default=0, help="AudioOutput index (default: %(default)s)")
     parser.add_argument("--camtype", 
@@ -177,10 +203,24 @@ def main():
                     nargs="?",
                     choices=["none", "picamera", "videocapture", "fake"],
                     help="(default: %(default)s)")
+    parser.add_argument("--fakecamframes", type=int, default=30, help="fake camera: frames rendered at startup per size (default: %(default)s)")
+    parser.add_argument("--fakecamsizes", type=str, default=None, help="fake camera: frame sizes e.g. 640x480,1280x720 (default: camwidth x camheight)")
+    parser.add_argument("--fakecamentropy", type=float, default=0.0, help="fake camera: fraction of each frame filled with noise 0..1, bigger jpgs (default: %(default)s)")
+    parser.add_argument("--fakecamstamp", action='store_true', help="fake camera: frame counter in a jpg comment (default: %(default)s)")
+    parser.add_argument("--mjpegpassthrough", action='store_true', help="videocapture: send the device's MJPG frames without decoding/encoding, falls back to encoding when unsupported or rotation/flip is set (default: %(default)s)")
+    parser.add_argument("--mjpegfile", type=str, default=None, help="videocapture: replay a file of concatenated jpgs instead of the device (default: %(default)s)")
+    parser.add_argument("--picamoutput", action='store_true', help="picamera: mjpeg recording into a custom output, frames are sent as soon as the encoder completes them (default: %(default)s)")
     parser.add_argument("--videocaptureindex", type=int, default=0, help="VideoCapture index (default: %(default)s)")
     parser.add_argument("--uart0", type=str, default=None, help="UART 0's serial device e.g. /dev/serial0 com4 (default: %(default)s)")
     parser.add_argument("--uart1", type=str, default=None, help="UART 1's serial device e.g. /dev/serial0 com4 (default: %(default)s)")
     parser.add_argument("--uart2", type=str, default=None, help="UART 2's serial device e.g. /dev/serial0 com4 (default: %(default)s)")
+    parser.add_argument("--uartrxbuffer", type=int, default=64*1024, help="UART receive buffer size in bytes (default: %(default)s)")
+    parser.add_argument("--uartoverflow", 
+                    default="oldest", 
+                    const="oldest",
+                    nargs="?",
+                    choices=["oldest", "newest"],
+                    help="UART receive buffer full: drop the oldest or the newest bytes (default: %(default)s)")
     parser.add_argument("--pca9685", 
                     default="none", 
                     const="none",
@@ -188,6 +228,16 @@ def main():
                     choices=["none", "servo", "pwm"],
                     help="servo=controller for servos, pwm=controller for pwm ports (default: %(default)s)")
     parser.add_argument("--pantilthat", action='store_true', help="enable Pimoroni Pan-Tilt HAT https://shop.pimoroni.com/products/pan-tilt-hat (default: %(default)s)")
+    parser.add_argument("--i2csharedfd", action='store_true', help="single /dev/i2c-N fd, every transfer carries the slave address (I2C_RDWR) (default: %(default)s)")
+    parser.add_argument("--i2cshadow", action='store_true', help="skip i2c register writes/reads the driver already knows the value of (default: %(default)s)")
+    parser.add_argument("--actuatortick", type=float, default=0, help="servo/pwm writes are coalesced and flushed every tick seconds e.g. 0.02, 0=write directly (default: %(default)s)")
+    parser.add_argument("--netengine", 
+                    default="threads", 
+                    const="threads",
+                    nargs="?",
+                    choices=["threads", "asyncio"],
+                    help="threads=one thread per connection, asyncio=single event loop for all servers (default: %(default)s)")
+    parser.add_argument("--ezbcapture", type=str, default=None, help="record every EZB session to a capture file in this directory, replay with EZBReplay.py (default: %(default)s)")
     parser.add_argument("--maestro", type=str, default=None, help="enable Pololu Maestro serial device e.g. /dev/ttyACM0 com40 (default: %(default)s)")
 
     args = parser.parse_args()
@@ -198,37 +248,45 @@ def main():
 
         setup_digital_ports()
 
-        i2c_com = setup_i2c()
+        i2c_com = setup_i2c(args.i2csharedfd)
     
         if args.uart0 is not None:
-            setup_SerialPortController("uart0", args.uart0, 115200)
+            setup_SerialPortController("uart0", args.uart0, 115200, args.uartrxbuffer, args.uartoverflow)
         if args.uart1 is not None:
-            setup_SerialPortController("uart1", args.uart1, 115200)
+            setup_SerialPortController("uart1", args.uart1, 115200, args.uartrxbuffer, args.uartoverflow)
         if args.uart2 is not None:
-            setup_SerialPortController("uart2", args.uart2, 115200)
+            setup_SerialPortController("uart2", args.uart2, 115200, args.uartrxbuffer, args.uartoverflow)
 
         if args.maestro is not None:
             ###Pololu Mini Maestro 24-Channel USB Servo Controller https://www.pololu.com/product/1356
             ###Used for 24 servos ports D0..D23
-            setup_serial_MaestroServoController(args.maestro)
+            setup_serial_MaestroServoController(args.maestro, args.actuatortick)
 
         if args.pca9685 == "pwm":
             ###Adafruit 16-Channel PWM https://www.adafruit.com/product/2327 
             ###Used for PWM ports (0..23)
-            setup_i2c_PCA9685Controller(i2c_com)
+            setup_i2c_PCA9685Controller(i2c_com, args.actuatortick, args.i2cshadow)
         elif args.pca9685 == "servo":
             ###Used for Servo ports (0..23)
-            setup_i2c_PCA9685ServoController(i2c_com)
+            setup_i2c_PCA9685ServoController(i2c_com, args.actuatortick, args.i2cshadow)
 
         if args.pantilthat:
             ###Pimoroni Pan-Tilt HAT  https://shop.pimoroni.com/products/pan-tilt-hat
             ###Used to map servo ports D0..D1
-            setup_i2c_PimoroniPanTiltHatServoController(i2c_com)
+            setup_i2c_PimoroniPanTiltHatServoController(i2c_com, args.actuatortick, args.i2cshadow)
+
+        net_engine = None
+        if args.netengine == "asyncio":
+            import AsyncNetEngine
+            net_engine = AsyncNetEngine.AsyncNetEngine(logging.DEBUG)
+            #registered before the servers so it is stopped after them
+            ComponentRegistry.ComponentRegistry.register_controller(net_engine)
+            net_engine.start()
 
-        EZBTcpServer.start((args.ezbaddr, args.ezbport))
+        EZBTcpServer.start((args.ezbaddr, args.ezbport), net_engine, args.ezbcapture)
 
         if args.camtype != "none":
-            EZBCameraServer.start((args.camaddr, args.camport), args)
+            EZBCameraServer.start((args.camaddr, args.camport), args, net_engine)
 
         #time.sleep(3)
         input("===> Press Enter to quit...\n")
@@ -0,0 +1,52 @@
+import logging
+import datetime
+import time
+import numpy
+
+class MotionGate:
+    """
+    Lets a raw frame through (to be encoded and sent) only when it differs from the last frame let through.
+    Frames are compared as small grayscale thumbnails (strided, no resampling): mean absolute difference in 0..255 levels.
+    keep_alive: a frame is let through at least every keep_alive seconds (0=never forced).
+    """
+    DEBUG_INTERVAL = 5 * 60 # 5 minutes
+
+    def __init__(self, logger, threshold=2.0, keep_alive=1.0, thumbnail_width=80):
+        self.logger = logger
+        self.threshold = threshold
+        self.keep_alive = keep_alive
+        self.thumbnail_width = thumbnail_width
+        self.last_thumbnail = None
+        self.last_time = 0
+        self.total_passed = 0
+        self.total_skipped = 0
+        self.last_debug_dt = None
+
+    def thumbnail(self, frame):
+        step = max(1, frame.shape[1] // self.thumbnail_width)
+        thumbnail = frame[::step, ::step]
+        if thumbnail.ndim == 3:
+            return thumbnail.mean(axis=2, dtype=numpy.float32)
+        return thumbnail.astype(numpy.float32)
+
+    def check(self, frame):
+        #returns True when the frame should be sent
+        thumbnail = self.thumbnail(frame)
+        now = time.monotonic()
+        passed = True
+        if self.last_thumbnail is not None and self.last_thumbnail.shape == thumbnail.shape:
+            if self.keep_alive <= 0 or now < self.last_time + self.keep_alive:
+                passed = numpy.abs(thumbnail - self.last_thumbnail).mean() >= self.threshold
+
+        if passed:
+            self.last_thumbnail = thumbnail
+            self.last_time = now
+            self.total_passed += 1
+        else:
+            self.total_skipped += 1
+
+        ds = 1917 if self.last_debug_dt is None else (datetime.datetime.now()-self.last_debug_dt).total_seconds()
+        if ds>=self.DEBUG_INTERVAL:
+            self.logger.debug("motion gate passed:%s skipped:%s", self.total_passed, self.total_skipped)
+            self.last_debug_dt = datetime.datetime.now()
+        return passed
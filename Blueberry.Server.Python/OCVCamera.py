@@ -3,21 +3,55 @@ import logging
 import time
 import cv2
 import CameraController
+import FramePipeline
+import MJPEGSource
 
 class OCVCameraController(CameraController.CameraController):
+    ROTATE_CODES = { 90: cv2.ROTATE_90_CLOCKWISE, 180: cv2.ROTATE_180, 270: cv2.ROTATE_90_COUNTERCLOCKWISE }
+    FLIP_CODES = { "horizontal": 1, "vertical": 0, "both": -1 }
 
-    def __init__(self, server, resolution, framerate, log_level, device_index=0, quality=95):
+    def __init__(self, server, resolution, framerate, log_level, device_index=0, quality=95, encode_workers=2, adaptive=None,
+                 rotation=0, flip="none", passthrough=False, mjpeg_file=None):
         super().__init__(self.__class__.__name__ + "-" + str(device_index), server, resolution, framerate, log_level)
         self.device_index = device_index
         self.quality = quality
+        #encode_workers=0: capture, encode and send in sequence on the camera thread
+        self.encode_workers = encode_workers
+        #AdaptiveQuality: quality and scale follow the viewers' bandwidth
+        self.adaptive = adaptive
+        self.rotation = rotation
+        self.flip = flip
+        #passthrough: the device's MJPG frames are sent as they are (no decode, no encode)
+        self.passthrough = passthrough
+        #mjpeg_file: frames from a file of concatenated jpgs instead of the device (passthrough)
+        self.mjpeg_file = mjpeg_file
+        self.pipeline = None
+        self.source = None
+        self._video_capture = None
 
     def setup(self):
+        if self.mjpeg_file is not None:
+            self.source = MJPEGSource.MJPEGFileSource(self.mjpeg_file, self.logger)
+            if not self.source.open():
+                self.logger.error("no jpg frames in file:%s", self.mjpeg_file)
+                return False
+            self.logger.debug("setup finished passthrough file:%s", self.mjpeg_file)
+            return True
+
         self.logger.debug("opening videocapture device=%s", self.device_index)
         self._video_capture = cv2.VideoCapture(self.device_index)
         if not self._video_capture.isOpened():
             self.logger.error("can't open video device:%s", self.device_index)
             return False
 
+        if self.passthrough:
+            if self.rotation != 0 or self.flip != "none":
+                self.logger.info("passthrough disabled, rotation=%s flip=%s need the encoder", self.rotation, self.flip)
+            else:
+                source = MJPEGSource.V4L2MJPEGSource(self._video_capture, self.logger)
+                if source.open():
+                    self.source = source
+
         w = self._video_capture.get(cv2.CAP_PROP_FRAME_WIDTH)
         h = self._video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT)
         f = self._video_capture.get(cv2.CAP_PROP_FPS)
@@ -32,7 +66,7 @@ class OCVCameraController(CameraController.CameraController):
         self.logger.debug("requested width=%s height=%s fps=%s", w, h, f)
 
         if w!=self.resolution[0] or h!=self.resolution[1]:
-            self.logger.error("video device:%s invalid resolution requested=% current=%s", 
+            self.logger.error("video device:%s invalid resolution requested=%s current=%s", 
                               self.device_index,
                               self.resolution,
                               (w,h))
@@ -41,35 +75,78 @@ class OCVCameraController(CameraController.CameraController):
 
         if f!=self.framerate:
             self.logger.warning("fps setting ignored requested=%s current=%s", self.framerate, f)
+
+        if self.source is not None and not self.source.probe():
+            self.source = None
+        self.logger.debug("passthrough=%s", self.source is not None)
+        if self.source is not None and self.adaptive is not None:
+            self.logger.warning("adaptive quality ignored in passthrough")
+        if self.source is not None and self.motion_gate is not None:
+            self.logger.warning("motion gate ignored in passthrough")
+
+        if self.encode_workers > 0 and self.source is None:
+            self.pipeline = FramePipeline.FramePipeline(self.name + "-pipeline", self.encode_frame, self.send_image, self.log_level, self.encode_workers)
+            self.pipeline.start()
         
         self.logger.debug("setup finished")
         return True
 
     def run_end(self):
-        self._video_capture.release()
+        if self.pipeline is not None:
+            self.pipeline.stop()
+            self.pipeline = None
+        if self.source is not None:
+            self.source.release()
+        if self._video_capture is not None:
+            self._video_capture.release()
         return
 
+    def encode_frame(self, frame):
+        if self.rotation in self.ROTATE_CODES:
+            frame = cv2.rotate(frame, self.ROTATE_CODES[self.rotation])
+        if self.flip in self.FLIP_CODES:
+            frame = cv2.flip(frame, self.FLIP_CODES[self.flip])
+        quality = self.quality
+        if self.adaptive is not None:
+            quality = self.adaptive.quality
+            scale = self.adaptive.scale
+            if scale < 1.0:
+                frame = cv2.resize(frame, (int(frame.shape[1] * scale), int(frame.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+        ret, jpg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ret:
+            self.logger.warning("no jpg")
+            return None
+        jpg_bytes = jpg.tobytes()
+        if self.adaptive is not None:
+            self.adaptive.frame_encoded(len(jpg_bytes))
+        return jpg_bytes
+
     def main(self):
-        frame_rate_delay = 1.0 / self.framerate
-        last_frame_time = 0
-        while not self.shutdown:
-            if last_frame_time != 0:
-                delay = time.time() - last_frame_time
-                if delay < frame_rate_delay:
-                    time.sleep(frame_rate_delay - delay)
+        while self.wait_for_viewers():
+            self.pace()
+
+            if self.source is not None:
+                self.capture_jpg()
+                continue
 
+            #read() returns a new array per frame, the pipeline can keep it while the next one is captured
             ret, frame = self._video_capture.read()
-            if ret:
-                ret, jpg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
-                if ret:
-                    jpg_bytes = jpg.tobytes()
-                    self.send_image(jpg_bytes)
+            if ret and (self.is_warming_up() or not self.is_motion(frame)):
+                pass
+            elif ret:
+                if self.pipeline is not None:
+                    self.pipeline.submit(frame)
                 else:
-                    self.logger.warning("no jpg")
+                    jpg_bytes = self.encode_frame(frame)
+                    if jpg_bytes is not None:
+                        self.send_image(jpg_bytes)
             else:
                 self.logger.warning("no frame")
-
-            last_frame_time = time.time()
         return
-        
 
+    def capture_jpg(self):
+        jpg = self.source.read_jpg()
+        if jpg is None:
+            self.logger.warning("no frame")
+        elif not self.is_warming_up():
+            self.send_image(jpg)
@@ -44,11 +44,16 @@ class PCA9685Controller(PWMController.PWMController):
     OCH           = 1<<3
     OUTDRV        = 1<<2
 
-    def __init__(self, i2c_controller, log_level, i2c_address=0x40, osc_clock=25000000):
+    #register shadow: ALL_LED_* read back as zero, MODE1's RESTART clears itself once written
+    SHADOW_VOLATILE_REGISTERS = (ALL_LED_ON_L, ALL_LED_ON_H, ALL_LED_OFF_L, ALL_LED_OFF_H)
+    SHADOW_WRITE_ONE_TO_CLEAR = { MODE1: RESTART }
+
+    def __init__(self, i2c_controller, log_level, i2c_address=0x40, osc_clock=25000000, shadow_registers=False):
         super().__init__(self.__class__.__name__+"-"+str(i2c_address), log_level)
         self.i2c_controller = i2c_controller
         self.i2c_address = i2c_address
         self._osc_clock = osc_clock
+        self.shadow_registers = shadow_registers
         self.slave = None
 
     def stop(self):
@@ -58,8 +63,11 @@ class PCA9685Controller(PWMController.PWMController):
 
     def start(self):
         self.slave = self.i2c_controller.get_slave(self.i2c_address)
+        if self.shadow_registers:
+            self.slave.enable_shadow(self.SHADOW_VOLATILE_REGISTERS, self.SHADOW_WRITE_ONE_TO_CLEAR)
         self.slave.write_reg_byte(self.MODE1, self.AI | self.ALLCALL)
-        self.slave.write_reg_byte(self.MODE2, self.OCH | self.OUTDRV)
+        #OCH cleared: outputs change on STOP, every channel of a block write is updated together
+        self.slave.write_reg_byte(self.MODE2, self.OUTDRV)
         time.sleep(0.0005)
         mode = self.slave.read_reg_byte(self.MODE1)
         self.slave.write_reg_byte(self.MODE1, mode & ~self.SLEEP)
@@ -93,22 +101,20 @@ class PCA9685Controller(PWMController.PWMController):
         self.pulse_width_us = (1000000.0 / self.frequency)
         self.logger.debug ("freq=%s pulse_width=%s (us per bit)", self.frequency, self.pulse_width_us)
 
-    def set_duty_cycle(self, port, value, max_value=100):
-        #Use -1 for all ports.
-
+    def get_on_off(self, value, max_value=100):
         if max_value == 4096:
             steps = int(value)
         else:
             steps = int(round(value * (4096.0 / max_value)))
         if steps < 0:
-            on = 0
-            off = 4096
+            return (0, 4096)
         elif steps >= 4096:
-            on = 4096
-            off = 0
-        else:
-            on = 0
-            off = steps
+            return (4096, 0)
+        return (0, steps)
+
+    def set_duty_cycle(self, port, value, max_value=100):
+        #Use -1 for all ports.
+        on, off = self.get_on_off(value, max_value)
         self.logger.debug("set_duty_cycle port=%s value=%s max_value=%s on=%s off=%s", port, value, max_value, on, off)
         if (port >= 0) and (port <= 15):
             data = [self.LED0_ON_L+4*port, on & 0xFF, on >> 8, off & 0xFF, off >> 8]
@@ -117,15 +123,62 @@ class PCA9685Controller(PWMController.PWMController):
             data = [self.ALL_LED_ON_L, on & 0xFF, on >> 8, off & 0xFF, off >> 8]
             self.slave.write(bytearray(data))
 
+    def set_duty_cycles(self, values, max_value=100):
+        #values: dict port => duty cycle
+        #contiguous ports are written with a single auto-increment (AI) write, up to 16 channels (64 bytes)
+        #the writes of every run go out in one combined transfer: a single STOP, all channels change together (OCH cleared)
+        channels = dict()
+        for port, value in values.items():
+            if (port >= 0) and (port <= 15):
+                channels[port] = self.get_on_off(value, max_value)
+        self.logger.debug("set_duty_cycles max_value=%s channels=%s", max_value, channels)
+        runs = []
+        for port in sorted(channels):
+            if len(runs) > 0 and port == runs[-1][-1] + 1:
+                runs[-1].append(port)
+            else:
+                runs.append([port])
+        #failures raise so the caller (ActuatorBus) forgets the frame and retries it
+        if len(runs) == 1:
+            if not self.slave.write(self.get_channels_data(runs[0], channels)):
+                raise IOError("set_duty_cycles: write failed ports={}".format(runs[0]))
+        elif len(runs) > 1:
+            transaction = self.i2c_controller.transaction()
+            for run in runs:
+                transaction.write(self.i2c_address, self.get_channels_data(run, channels))
+            try:
+                transaction.submit()
+            except Exception as ex:
+                self.logger.error("set_duty_cycles: ex=%s", ex)
+                raise
+
+    def get_channels_data(self, ports, channels):
+        data = bytearray(1 + 4 * len(ports))
+        data[0] = self.LED0_ON_L + 4 * ports[0]
+        ix = 1
+        for port in ports:
+            on, off = channels[port]
+            data[ix] = on & 0xFF
+            data[ix+1] = on >> 8
+            data[ix+2] = off & 0xFF
+            data[ix+3] = off >> 8
+            ix += 4
+        return data
+
     def set_pulse_width(self, channel, width_in_us):
         #self.set_duty_cycle(channel, (float(width_in_us) / self.pulse_width_us) * 100.0)
         steps = round((width_in_us * 4096)/self.pulse_width_us)
         self.set_duty_cycle(channel, steps, 4096)
 
+    def set_pulse_widths(self, widths_in_us):
+        #widths_in_us: dict channel => width in us
+        steps = { channel: round((width_in_us * 4096)/self.pulse_width_us) for channel, width_in_us in widths_in_us.items() }
+        self.set_duty_cycles(steps, 4096)
+
 class PCA9685ServoController(PCA9685Controller, ServoController.ServoController):
-    def __init__(self, i2c_controller, log_level, i2c_address=0x40, osc_clock=25000000):
+    def __init__(self, i2c_controller, log_level, i2c_address=0x40, osc_clock=25000000, shadow_registers=False):
         self._started = False
-        PCA9685Controller.__init__(self, i2c_controller, log_level, i2c_address, osc_clock)
+        PCA9685Controller.__init__(self, i2c_controller, log_level, i2c_address, osc_clock, shadow_registers)
 
     def start(self):
         super().start()
@@ -148,6 +201,11 @@ class PCA9685ServoController(PCA9685Controller, ServoController.ServoController)
         super().set_position(port, position_in_us)
         self.set_pulse_width(port, position_in_us)
 
+    def set_positions(self, positions_in_us):
+        #positions_in_us: dict port => position in us, written as one frame
+        self.logger.debug("set_positions positions_in_us=%s", positions_in_us)
+        self.set_pulse_widths(positions_in_us)
+
     def set_speed(self, port, speed):
         pass
 
@@ -2,11 +2,11 @@ import logging
 import Controller
 
 class PWMPort:
+    __slots__ = ("pwm_controller", "port")
+
     def __init__(self, pwm_controller, port):
         self.pwm_controller = pwm_controller
         self.port = port
-        self.logger = logging.getLogger("{}-{}".format(pwm_controller.name, port))
-        self.logger.setLevel(pwm_controller.log_level)
 
     def set_duty_cycle(self, percent):
         self.pwm_controller.set_duty_cycle(self.port, percent)
@@ -7,10 +7,16 @@ import datetime
 import time
 import picamera
 import CameraController
+import PiCameraFrameOutput
 
 class PiCameraController(CameraController.CameraController):
-    def __init__(self, server, resolution, framerate, rotation, flip, log_level):
+    #auto exposure/white balance settle time
+    CAMERA_WARM_UP = 2
+
+    def __init__(self, server, resolution, framerate, rotation, flip, log_level, custom_output=False):
         super().__init__("PiCameraController", server, resolution, framerate, log_level)
+        #custom_output: mjpeg recording into PiCameraFrameOutput instead of capture_continuous
+        self.custom_output = custom_output
 
         self.camera = picamera.PiCamera()
         (width, height) = self.resolution
@@ -25,14 +31,22 @@ class PiCameraController(CameraController.CameraController):
         self.logger.debug("framerate previous=%s current=%s", prev_framerate, self.camera.framerate)
 
     def main(self):
+        if self.custom_output:
+            self.main_recording()
+            return
         #self.camera.start_preview()
-        time.sleep(2)
+        time.sleep(self.CAMERA_WARM_UP)
         stream = io.BytesIO()
         for foo in self.camera.capture_continuous(stream, "jpeg", use_video_port=True):
-            if self.shutdown:
+            if not self.wait_for_viewers():
                 break
-            stream.seek(0)
-            img_bytes = bytes(stream.read())
+            self.frame_captured()
+            if self.is_warming_up():
+                stream.seek(0)
+                stream.truncate()
+                continue
+            #single copy out of the reused stream, shared by every client
+            img_bytes = stream.getvalue()
             self.send_image(img_bytes)
             if img_bytes[0] != 255 or img_bytes[1] != 216:
                 self.logger.warning("JPG's SOI missing")
@@ -41,6 +55,31 @@ class PiCameraController(CameraController.CameraController):
             stream.seek(0)
             stream.truncate()
 
+    def main_recording(self):
+        #frames are published from the encoder thread as soon as they are complete
+        #this thread only starts/stops the recording and surfaces encoder errors
+        output = PiCameraFrameOutput.PiCameraFrameOutput(self.publish_frame, self.logger, self.camera)
+        self.warm_up_time = time.monotonic() + self.CAMERA_WARM_UP
+        recording = False
+        try:
+            while self.wait_for_viewers():
+                if not recording:
+                    self.camera.start_recording(output, format="mjpeg")
+                    recording = True
+                self.camera.wait_recording(self.IDLE_TIMEOUT)
+                if not self.is_wanted():
+                    self.camera.stop_recording()
+                    recording = False
+        finally:
+            if recording:
+                self.camera.stop_recording()
+
+    def publish_frame(self, view):
+        #encoder thread
+        self.frame_captured()
+        if not self.is_warming_up():
+            self.send_image(view)
+
     def run_end(self):
         #self.camera.stop_preview()
         pass
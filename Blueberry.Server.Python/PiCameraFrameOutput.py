@@ -0,0 +1,77 @@
+import logging
+
+#jpg start and end of image markers
+SOI = b"\xff\xd8"
+EOI = b"\xff\xd9"
+
+class PiCameraFrameOutput:
+    """
+    picamera custom output for camera.start_recording(output, format="mjpeg").
+    The encoder thread calls write() with the chunks of each frame, they are collected into a pooled buffer and
+    the complete frame is published as a read only memoryview (no copy).
+    A pooled buffer is reused once nothing references its published view anymore (the servers dropped the frame),
+    bytearray refuses to resize while a view is exported so that is what tells a buffer is free.
+    """
+    BUFFER_SIZE = 256 * 1024
+
+    def __init__(self, publish, logger, camera=None, pool_size=4):
+        #publish(view) is called on the encoder thread
+        self.publish = publish
+        self.logger = logger
+        #frame end comes from camera.frame.complete when available, from the EOI marker otherwise (stand-in encoders)
+        self.camera = camera
+        self.pool = [bytearray(self.BUFFER_SIZE) for ix in range(pool_size)]
+        self.buffer = None
+        self.length = 0
+        self.total_frames = 0
+        self.total_incomplete = 0
+        self.total_allocated = 0
+
+    def is_free(self, buffer):
+        try:
+            buffer.append(0)
+        except BufferError:
+            return False
+        buffer.pop()
+        return True
+
+    def get_buffer(self):
+        for buffer in self.pool:
+            if self.is_free(buffer):
+                return buffer
+        #every pooled buffer still in use, this frame gets its own
+        self.total_allocated += 1
+        return bytearray(self.BUFFER_SIZE)
+
+    def write(self, chunk):
+        size = len(chunk)
+        if self.buffer is None:
+            self.buffer = self.get_buffer()
+            self.length = 0
+        elif chunk[:len(SOI)] == SOI:
+            #new frame before the previous one completed
+            self.total_incomplete += 1
+            self.length = 0
+
+        end = self.length + size
+        if end <= len(self.buffer):
+            self.buffer[self.length:end] = chunk
+        else:
+            del self.buffer[self.length:]
+            self.buffer += chunk
+        self.length = end
+
+        if self.camera is not None:
+            complete = self.camera.frame.complete
+        else:
+            complete = self.buffer[end - len(EOI):end] == EOI
+        if complete:
+            view = memoryview(self.buffer)[:self.length].toreadonly()
+            self.buffer = None
+            self.total_frames += 1
+            self.publish(view)
+        return size
+
+    def flush(self):
+        self.logger.debug("output flush frames:%s incomplete:%s allocated:%s", self.total_frames, self.total_incomplete, self.total_allocated)
+        self.buffer = None
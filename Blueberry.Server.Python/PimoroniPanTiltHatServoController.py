@@ -18,11 +18,15 @@ class PimoroniPanTiltHatServoController(ServoController.ServoController):
     REG_UPDATE = 0x4E
     
     UPDATE_WAIT = 0.03
+
+    #register shadow: writing REG_UPDATE triggers the lights refresh, it must always reach the HAT
+    SHADOW_VOLATILE_REGISTERS = (REG_UPDATE,)
     
-    def __init__(self, i2c_controller, log_level, i2c_address=0x15):
+    def __init__(self, i2c_controller, log_level, i2c_address=0x15, shadow_registers=False):
         super().__init__("PimoroniPanTiltHatServoController", log_level)
         self.i2c_controller = i2c_controller
         self.i2c_address = i2c_address
+        self.shadow_registers = shadow_registers
         self.slave = None
 
         self._enable_servo1 = False
@@ -33,6 +37,8 @@ class PimoroniPanTiltHatServoController(ServoController.ServoController):
 
     def start(self):
         self.slave = self.i2c_controller.get_slave(self.i2c_address)
+        if self.shadow_registers:
+            self.slave.enable_shadow(self.SHADOW_VOLATILE_REGISTERS)
         self._set_config()
 
     def stop(self):
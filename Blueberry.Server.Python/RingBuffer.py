@@ -0,0 +1,99 @@
+class RingBuffer:
+    """
+    Preallocated byte ring buffer.
+    Producers either copy with write() or fill write_view() directly (e.g. socket.recv_into) and commit().
+    Consumers either copy with read()/read_into() or use read_view() and consume().
+    Views share the underlying memory and are only valid until the buffer is written again.
+    Not thread safe, callers must provide their own locking.
+    """
+
+    def __init__(self, capacity):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._head = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def free(self):
+        return self.capacity - self._size
+
+    def clear(self):
+        self._head = 0
+        self._size = 0
+
+    def write_view(self, max_size=None):
+        #contiguous free region after the last written byte
+        if self._size == 0:
+            self._head = 0
+        tail = (self._head + self._size) % self.capacity
+        if tail >= self._head and self._size < self.capacity:
+            end = self.capacity
+        else:
+            end = self._head
+        if max_size is not None and end - tail > max_size:
+            end = tail + max_size
+        return self._view[tail:end]
+
+    def commit(self, size):
+        if size > self.free:
+            raise ValueError("commit exceeds free space")
+        self._size += size
+
+    def write(self, data):
+        #copies as much of data as fits, returns the number of bytes written
+        data = memoryview(data)
+        written = 0
+        while written < len(data) and self._size < self.capacity:
+            view = self.write_view(len(data) - written)
+            n = len(view)
+            view[:] = data[written:written + n]
+            self._size += n
+            written += n
+        return written
+
+    def read_view(self, max_size=None):
+        #contiguous readable region starting at the oldest byte
+        end = self._head + self._size
+        if end > self.capacity:
+            end = self.capacity
+        if max_size is not None and end - self._head > max_size:
+            end = self._head + max_size
+        return self._view[self._head:end]
+
+    def consume(self, size):
+        if size > self._size:
+            raise ValueError("consume exceeds available bytes")
+        self._size -= size
+        if self._size == 0:
+            #keep the free space contiguous
+            self._head = 0
+        else:
+            self._head = (self._head + size) % self.capacity
+
+    def read_into(self, dest):
+        #copies up to len(dest) bytes into dest, returns the number of bytes copied
+        dest = memoryview(dest)
+        copied = 0
+        while copied < len(dest) and self._size > 0:
+            view = self.read_view(len(dest) - copied)
+            n = len(view)
+            dest[copied:copied + n] = view
+            self.consume(n)
+            copied += n
+        return copied
+
+    def read(self, size):
+        view = self.read_view(size)
+        if len(view) == size or len(view) == self._size:
+            data = view.tobytes()
+            self.consume(len(data))
+            return data
+        data = bytearray(min(size, self._size))
+        self.read_into(data)
+        return bytes(data)
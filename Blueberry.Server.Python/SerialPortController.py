@@ -4,14 +4,22 @@ import logging
 import os
 import datetime
 import time
+import select
 import serial
 import serial.tools.list_ports
 import Controller
+import RingBuffer
 
 class SerialPortController(Controller.Controller):
     DEBUG_INTERVAL = 5 * 60 # 5 minutes
-
-    def __init__(self, port, baud_rate, log_level):
+    #the reader wakes up at least this often to check for shutdown
+    POLL_TIMEOUT = 0.5
+    RX_CAPACITY = 64 * 1024
+    #rx buffer full: discard the oldest buffered bytes or the newly received ones
+    OVERFLOW_DROP_OLDEST = "oldest"
+    OVERFLOW_DROP_NEWEST = "newest"
+
+    def __init__(self, port, baud_rate, log_level, rx_capacity=None, overflow=OVERFLOW_DROP_OLDEST):
         self.port = port
         self.baud_rate = baud_rate
         self.name = "dev-{}".format(port)
@@ -20,8 +28,12 @@ class SerialPortController(Controller.Controller):
         self.lock = threading.Lock()
         self.shutdown = True
         self.serial = None
-        self.all_data = bytearray()
+        #received bytes nobody read yet, fixed capacity so an unread chatty device can't grow the process
+        self.rx_buffer = RingBuffer.RingBuffer(rx_capacity or self.RX_CAPACITY)
+        self.overflow = overflow
         self.total_bytes_read = 0
+        self.total_overflowed = 0
+        self.total_padded = 0
         self.is_data_ready = threading.Event()
         self.is_data_ready.clear()
 
@@ -45,31 +57,61 @@ class SerialPortController(Controller.Controller):
         self.shutdown = True
         self.run_thread.join()
 
+    def get_poller(self):
+        #poll object watching the port's fd or None when the port has no pollable fd (windows)
+        if not hasattr(select, "poll"):
+            return None
+        try:
+            fd = self.serial.fileno()
+        except Exception:
+            return None
+        poller = select.poll()
+        poller.register(fd, select.POLLIN | select.POLLERR | select.POLLHUP)
+        return poller
+
+    def read_port(self, poller):
+        #blocks up to POLL_TIMEOUT for data, returns everything available (empty on timeout)
+        if poller is not None:
+            if len(poller.poll(self.POLL_TIMEOUT * 1000)) == 0:
+                return b""
+            return self.serial.read(max(1, self.serial.inWaiting()))
+
+        #the driver blocks the first byte's read (serial timeout = POLL_TIMEOUT)
+        data = self.serial.read(1)
+        if len(data) == 0:
+            return data
+        available = self.serial.inWaiting()
+        if available > 0:
+            data += self.serial.read(available)
+        return data
+
     def run(self):
         self.logger.debug("started")
         try:
             last_debug_dt = None
+            poller = self.get_poller()
+            if poller is None:
+                self.serial.timeout = self.POLL_TIMEOUT
+            self.logger.debug("poll=%s", poller is not None)
 
             while not self.shutdown:
                 if self.serial.isOpen():
-                    if self.serial.inWaiting()>0:
-                        data = self.serial.read(self.serial.inWaiting())
-
+                    data = self.read_port(poller)
+                    if len(data) > 0:
                         self.lock.acquire()
                         try:
-                            self.all_data += data
+                            self.store(data)
                             self.total_bytes_read += len(data)
                             self.is_data_ready.set()
                         finally:
                             self.lock.release()
-
-                        time.sleep(0.1) # Wait 100ms
                 else:
                     time.sleep(1) # Wait 1s
 
                 ds = 1917 if last_debug_dt is None else (datetime.datetime.now()-last_debug_dt).total_seconds()
                 if ds>=self.DEBUG_INTERVAL:
-                    self.logger.debug("run isOpen:%s available_bytes:%s total_bytes_read:%s", self.serial.isOpen(), self.get_available_bytes(), self.total_bytes_read)
+                    self.logger.debug("run isOpen:%s available_bytes:%s total_bytes_read:%s overflowed:%s padded:%s",
+                                      self.serial.isOpen(), self.get_available_bytes(), self.total_bytes_read, self.total_overflowed, self.total_padded)
                     last_debug_dt = datetime.datetime.now()
         except Exception as ex:
             self.shutdown = True
@@ -80,6 +122,20 @@ class SerialPortController(Controller.Controller):
 
         self.logger.debug("terminated")
 
+    def store(self, data):
+        #reader thread, the lock is held
+        free = self.rx_buffer.free
+        if len(data) > free:
+            self.total_overflowed += len(data) - free
+            if self.overflow == self.OVERFLOW_DROP_NEWEST:
+                data = memoryview(data)[:free]
+            elif len(data) >= self.rx_buffer.capacity:
+                self.rx_buffer.clear()
+                data = memoryview(data)[len(data) - self.rx_buffer.capacity:]
+            else:
+                self.rx_buffer.consume(len(data) - free)
+        self.rx_buffer.write(data)
+
     def write(self, data):
         if self.serial.isOpen():
             self.serial.write(data)
@@ -88,17 +144,13 @@ class SerialPortController(Controller.Controller):
         missing = 0
         self.lock.acquire()
         try:
-            if len(self.all_data)>=bytes_to_read:
-                data = self.all_data[:bytes_to_read]
-                self.all_data = self.all_data[bytes_to_read:]
-            else:
-                data = self.all_data
-                self.all_data = bytearray()
-                if fill_zeros_if_missing:
-                    missing = bytes_to_read - len(data)
-                    data += bytes([0] * missing)
+            data = self.rx_buffer.read(bytes_to_read)
+            if len(data) < bytes_to_read and fill_zeros_if_missing:
+                missing = bytes_to_read - len(data)
+                self.total_padded += missing
+                data += bytes(missing)
 
-            if len(self.all_data)>0 or self.shutdown:
+            if len(self.rx_buffer)>0 or self.shutdown:
                 self.is_data_ready.set()
             else:
                 self.is_data_ready.clear()
@@ -106,19 +158,19 @@ class SerialPortController(Controller.Controller):
             self.lock.release()
         if missing:        
             self.logger.warning("read bytes_to_read:%s missing:%s", bytes_to_read, missing)
-        return bytes(data)
+        return data
 
     def get_available_bytes(self):
         self.lock.acquire()
         try:
-            return len(self.all_data)
+            return len(self.rx_buffer)
         finally:
             self.lock.release()
 
     def clear_buffer(self):
         self.lock.acquire()
         try:
-            self.all_data = bytearray()
+            self.rx_buffer.clear()
         finally:
             self.lock.release()
 
@@ -2,6 +2,11 @@ import logging
 import Controller
 
 class ServoPort:
+    __slots__ = ("servo_controller", "port", "min_us", "max_us", "min_degrees", "max_degrees", "us_table")
+
+    #degrees lookup table covers every position an EZB command can carry
+    TABLE_SIZE = 256
+
     def __init__(self, servo_controller, port, min_us, max_us, min_degrees=0, max_degrees=179):
         self.servo_controller = servo_controller
         self.port = port
@@ -9,16 +14,21 @@ class ServoPort:
         self.max_us = max_us
         self.min_degrees = min_degrees
         self.max_degrees = max_degrees
-        self.logger = logging.getLogger("{}-{}".format(servo_controller.name, port))
-        self.logger.setLevel(servo_controller.log_level)
+        self.us_table = tuple(self.clamp_us(self.degrees_to_us(degrees)) for degrees in range(self.TABLE_SIZE))
 
     def set_position(self, position_in_degrees):
-        position_in_us = self.degrees_to_us(position_in_degrees)
+        if 0 <= position_in_degrees < self.TABLE_SIZE:
+            position_in_us = self.us_table[position_in_degrees]
+        else:
+            position_in_us = self.clamp_us(self.degrees_to_us(position_in_degrees))
+        self.servo_controller.set_position(self.port, position_in_us)
+
+    def clamp_us(self, position_in_us):
         if position_in_us>self.max_us:
             position_in_us = self.max_us
         elif position_in_us<self.min_us:
             position_in_us = self.min_us
-        self.servo_controller.set_position(self.port, position_in_us)
+        return position_in_us
 
     def set_speed(self, speed):
         self.servo_controller.set_speed(self.port, speed)
@@ -5,17 +5,19 @@ import os
 import datetime
 import time
 import socket
+import RingBuffer
 
 class TcpClient:
+    RECV_BUFFER_CAPACITY = 64 * 1024
 
-    def __init__(self, name, server, client_socket, client_address):
+    def __init__(self, name, server, client_socket, client_address, recv_buffer_capacity=None):
         self.name = "{}-{}".format(name, client_address)
         self.server = server
         self.socket = client_socket
         self.client_address = client_address
         self.logger = logging.getLogger(self.name)
         self.logger.setLevel(self.server.log_level)
-        self.all_data = bytearray() 
+        self.rx_buffer = RingBuffer.RingBuffer(recv_buffer_capacity or self.RECV_BUFFER_CAPACITY)
         self.shutdown = False
 
         self.run_thread = threading.Thread(target=self.run, args=())
@@ -27,28 +29,37 @@ class TcpClient:
         self.logger.debug("join th:%s", self.run_thread.getName())
         self.run_thread.join()
 
-    def recv(self, req_size):
+    def fill(self):
+        #receives into the ring buffer's free space
+        #returns the number of bytes received, 0 when the buffer is full or None when the connection is closed
+        if self.rx_buffer.free == 0:
+            return 0
+        view = self.rx_buffer.write_view()
+        while not self.shutdown:
+            try:
+                size = self.socket.recv_into(view)
+            except socket.timeout as ex:
+                continue
+
+            if size == 0:
+                return None
+            self.rx_buffer.commit(size)
+            return size
+        return None
+
+    def recv_available(self):
+        #returns a memoryview over the received bytes or None when the connection is closed
+        #the view shares the ring buffer's memory and is only valid until the next recv call
         try:
-            seq = 0
-            while not self.shutdown:
-                if req_size<=len(self.all_data):
-                    data = self.all_data[:req_size]
-                    self.all_data = self.all_data[req_size:]
-                    return bytes(data)
-                try:
-                    data = self.socket.recv(10240)
-                except socket.timeout as ex:
-                    continue
-
-                if data is None or data == b"":
-                    return None
-                self.all_data += data
-                self.logger.debug("recv seq=%s len=%s len2=%s", seq, len(data), len(self.all_data))
-                seq += 1
+            if len(self.rx_buffer) == 0 and self.fill() is None:
+                return None
+            view = self.rx_buffer.read_view()
+            self.rx_buffer.consume(len(view))
+            return view
         except socket.error as ex:
             self.logger.error("recv ex=%s", ex)
         return None
-    
+
     def main(self):
         while not self.shutdown:
             try:
@@ -78,8 +89,47 @@ class TcpClient:
     
     def send(self, data):
         try:
-            self.socket.send(data)
+            self.send_all(data)
         except Exception as ex:
             self.logger.debug("send exception %s", ex)
 
+    def send_all(self, data):
+        #socket.sendall can't tell how much was written when it times out, a partial write would corrupt the stream
+        #returns False when the client is shutting down before every byte is sent
+        view = memoryview(data)
+        sent = 0
+        while sent < len(view):
+            if self.shutdown:
+                return False
+            try:
+                sent += self.socket.send(view[sent:])
+            except socket.timeout as ex:
+                continue
+        return True
+
+    def send_buffers(self, buffers):
+        #writes the buffers back to back without joining them (sendmsg scatter-gather)
+        #returns False when the client is shutting down before every byte is sent
+        if not hasattr(self.socket, "sendmsg"):
+            #windows
+            for data in buffers:
+                if not self.send_all(data):
+                    return False
+            return True
+
+        views = [memoryview(data) for data in buffers]
+        while len(views) > 0:
+            if self.shutdown:
+                return False
+            try:
+                sent = self.socket.sendmsg(views)
+            except socket.timeout as ex:
+                continue
+            while len(views) > 0 and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            if sent > 0:
+                views[0] = views[0][sent:]
+        return True
+
 
@@ -1,29 +1,58 @@
 import sys
+import argparse
 import threading
 import logging
 import os
 import datetime
 import time
 import socket
+import asyncio
+import collections
 import SerialPortController
+import AsyncNetEngine
 
 
 class TcpSerialPortClient:
+    """
+    Serial data is queued per client and written by the client's own writer thread,
+    a slow client only delays (and past MAX_QUEUED_BYTES drops) its own data.
+    Queued chunks are coalesced into sends of up to MAX_SEND_SIZE bytes.
+    """
+    DEBUG_INTERVAL = 5 * 60 # 5 minutes
+    MAX_QUEUED_BYTES = 256 * 1024
+    MAX_SEND_SIZE = 64 * 1024
 
     def __init__(self, server, client_socket, client_address):
         self.logger = logging.getLogger("TcpSerialPortClient-{}".format(client_address))
         self.server = server
         self.socket = client_socket
         self.client_address = client_address
+        self.shutdown = False
+        #(receive time, data) chunks waiting for the writer
+        self.chunks = collections.deque()
+        self.queued_bytes = 0
+        self.chunks_ready = threading.Condition()
+        self.total_bytes_sent = 0
+        self.total_bytes_dropped = 0
+        self.total_sends = 0
+        self.total_latency = 0
+        self.max_latency = 0
+        self.socket.settimeout(2.0)
         self.run_thread = threading.Thread(target=self.run, args=())
         self.run_thread.start()
+        self.send_thread = threading.Thread(target=self.run_send, args=())
+        self.send_thread.start()
 
     def run(self):
         self.logger.debug("running thread:%s", threading.current_thread().getName())
     
         try:
-            while not self.server.shutdown:
-                data = self.socket.recv(1024)
+            while not self.server.shutdown and not self.shutdown:
+                try:
+                    data = self.socket.recv(1024)
+                except socket.timeout:
+                    #listen only clients (e.g. lidar) never send anything
+                    continue
                 if data is None or data == b"":
                     break
                 self.server.serial_port_component.write(data)
@@ -32,21 +61,103 @@ class TcpSerialPortClient:
             self.logger.debug("run exception %s", e)
 
         self.logger.debug("shutting down....")
+        self.stop_sending()
+        self.send_thread.join()
         self.socket.close()
         self.server.unregister_client(self)
+        self.log_counters()
         self.logger.debug("terminated")
 
     def stop(self):
         self.logger.debug("stopping client:%s ...", self.client_address)
+        self.stop_sending()
         self.socket.close()
 
-    def send(self, data):
+    def stop_sending(self):
+        self.chunks_ready.acquire()
+        try:
+            self.shutdown = True
+            self.chunks_ready.notify_all()
+        finally:
+            self.chunks_ready.release()
+
+    def send(self, data, receive_time=None):
+        #serial thread, never blocks
+        self.chunks_ready.acquire()
+        try:
+            self.chunks.append((receive_time or time.monotonic(), data))
+            self.queued_bytes += len(data)
+            while self.queued_bytes > self.MAX_QUEUED_BYTES and len(self.chunks) > 1:
+                dropped_time, dropped = self.chunks.popleft()
+                self.queued_bytes -= len(dropped)
+                self.total_bytes_dropped += len(dropped)
+            self.chunks_ready.notify()
+        finally:
+            self.chunks_ready.release()
+
+    def next_batch(self):
+        #returns (oldest receive time, data) or None on shutdown
+        self.chunks_ready.acquire()
         try:
-            self.socket.sendall(data)
+            while not self.shutdown and len(self.chunks) == 0:
+                self.chunks_ready.wait()
+            if self.shutdown:
+                return None
+            receive_time, data = self.chunks.popleft()
+            if len(self.chunks) > 0 and len(data) < self.MAX_SEND_SIZE:
+                data = bytearray(data)
+                while len(self.chunks) > 0 and len(data) + len(self.chunks[0][1]) <= self.MAX_SEND_SIZE:
+                    data += self.chunks.popleft()[1]
+            self.queued_bytes -= len(data)
+            return (receive_time, data)
+        finally:
+            self.chunks_ready.release()
+
+    def send_all(self, data):
+        view = memoryview(data)
+        sent = 0
+        while sent < len(view):
+            if self.shutdown:
+                return False
+            try:
+                sent += self.socket.send(view[sent:])
+            except socket.timeout as ex:
+                continue
+        return True
+
+    def run_send(self):
+        last_debug_dt = None
+        try:
+            while not self.shutdown:
+                batch = self.next_batch()
+                if batch is None:
+                    break
+                receive_time, data = batch
+                if not self.send_all(data):
+                    break
+                latency = time.monotonic() - receive_time
+                self.total_bytes_sent += len(data)
+                self.total_sends += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+                ds = 1917 if last_debug_dt is None else (datetime.datetime.now()-last_debug_dt).total_seconds()
+                if ds>=self.DEBUG_INTERVAL:
+                    self.log_counters()
+                    last_debug_dt = datetime.datetime.now()
         except Exception as e:
             self.logger.debug("send ex:%s", e)
+            #unblocks the reader
+            self.socket.close()
+
+    def log_counters(self):
+        avg_latency = self.total_latency / self.total_sends if self.total_sends > 0 else 0
+        self.logger.debug("sent:%s bytes in %s sends dropped:%s latency avg:%.1fms max:%.1fms",
+                          self.total_bytes_sent, self.total_sends, self.total_bytes_dropped, avg_latency * 1000, self.max_latency * 1000)
 
 class TcpSerialPortBridge(object):
+    DATA_READY_TIMEOUT = 0.5
+
     def __init__(self, port, serial_port_component):
         self.logger = logging.getLogger("TcpSerialPortBridge")
         self.port = port
@@ -60,19 +171,22 @@ class TcpSerialPortBridge(object):
 
     def run_serial(self):
         self.logger.debug("run_serial started")
+        component = self.serial_port_component
         try:
             while not self.shutdown:
-                if self.serial_port_component.is_data_ready.isSet():
-                    if self.shutdown:
-                        break
-                    data_len = self.serial_port_component.get_available_bytes()
-                    data = self.serial_port_component.read(data_len)
-                    if self.shutdown:
-                        break
-                    clients = self.clients.copy()
-                    for client in clients: 
-                        client.send(data)
-                        time.sleep(0.1) # Wait 100ms
+                if component.shutdown:
+                    #not started yet or stopped, is_data_ready stays set
+                    time.sleep(self.DATA_READY_TIMEOUT)
+                    continue
+                if not component.is_data_ready.wait(self.DATA_READY_TIMEOUT) or self.shutdown:
+                    continue
+                data = component.read(component.get_available_bytes(), False)
+                if len(data) == 0:
+                    continue
+                receive_time = time.monotonic()
+                clients = self.clients.copy()
+                for client in clients: 
+                    client.send(data, receive_time)
         except Exception as ex:
             self.logger.debug("run_serial exception ex=%s", ex)
 
@@ -130,6 +244,7 @@ class TcpSerialPortBridge(object):
         for client in clients: 
             self.logger.debug("join th:%s client:%s", client.run_thread.getName(), client.client_address)
             client.run_thread.join()
+            client.send_thread.join()
 
         self.logger.debug("join th:%s run_serial_thread", self.run_serial_thread.getName())
         self.run_serial_thread.join()
@@ -147,15 +262,106 @@ class TcpSerialPortBridge(object):
     def unregister_client(self, client):
         self.lock.acquire()
         try:
+            if client not in self.clients:
+                return
             self.clients.remove(client)
             self.logger.debug("unregister client:%s #clients:%s", client.client_address, len(self.clients))
         finally:
             self.lock.release()
 
+class AsyncTcpSerialPortClient(AsyncNetEngine.AsyncTcpClient):
+    def __init__(self, server):
+        super().__init__("AsyncTcpSerialPortClient", server)
+
+    def data_received(self, data):
+        self.server.write_serial(data)
+
+class AsyncTcpSerialPortBridge(AsyncNetEngine.AsyncTcpServer):
+    DATA_READY_TIMEOUT = 0.5
+
+    def __init__(self, engine, port, serial_port_component, log_level=logging.DEBUG):
+        super().__init__("AsyncTcpSerialPortBridge", engine, ("", port), log_level)
+        self.port = port
+        self.serial_port_component = serial_port_component
+        self.serial_future = None
+        self.pending_writes = bytearray()
+        self.writing = False
+
+    def get_client_instance(self):
+        return AsyncTcpSerialPortClient(self)
+
+    def start(self):
+        super().start()
+        if not self.shutdown:
+            self.serial_future = self.engine.run_coroutine(self.run_serial())
+
+    def stop(self):
+        super().stop()
+        if self.serial_future is not None:
+            try:
+                self.serial_future.result(self.engine.STOP_TIMEOUT)
+            except Exception as ex:
+                self.logger.debug("stop ex=%s", ex)
+
+    def write_serial(self, data):
+        #event loop only, one write in flight keeps the bytes in order
+        self.pending_writes += data
+        if not self.writing:
+            self.write_pending()
+
+    def write_pending(self):
+        if len(self.pending_writes) == 0:
+            self.writing = False
+            return
+        data = bytes(self.pending_writes)
+        self.pending_writes.clear()
+        self.writing = True
+        future = self.engine.run_hardware(self.serial_port_component.write, data)
+        future.add_done_callback(self.write_done)
+
+    def write_done(self, future):
+        try:
+            future.result()
+        except Exception as ex:
+            self.logger.debug("write ex=%s", ex)
+        self.write_pending()
+
+    def read_serial(self):
+        #hardware executor, no zero padding reaches the clients
+        component = self.serial_port_component
+        return component.read(component.get_available_bytes(), False)
+
+    async def run_serial(self):
+        self.logger.debug("run_serial started")
+        loop = asyncio.get_event_loop()
+        component = self.serial_port_component
+        try:
+            while not self.shutdown and not component.shutdown:
+                #waiting happens on the default executor, the hardware executor stays free
+                ready = await loop.run_in_executor(None, component.is_data_ready.wait, self.DATA_READY_TIMEOUT)
+                if not ready or self.shutdown:
+                    continue
+                data = await self.engine.run_hardware(self.read_serial)
+                if len(data) > 0:
+                    self.send_all(data)
+        except Exception as ex:
+            self.logger.debug("run_serial exception ex=%s", ex)
+
+        self.logger.debug("run_serial terminated")
+
 def main():
     logging.basicConfig(format="%(process)d-%(name)s-%(levelname)s-%(message)s", level=logging.DEBUG)
     logging.info("Starting... platform=%s hostname=%s", sys.platform, socket.gethostname())
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--netengine", 
+                    default="threads", 
+                    const="threads",
+                    nargs="?",
+                    choices=["threads", "asyncio"],
+                    help="threads=one thread per connection, asyncio=single event loop (default: %(default)s)")
+    args = parser.parse_args()
+
     SerialPortController.SerialPortController.list_ports()
 
     port_name = None
@@ -164,10 +370,16 @@ def main():
     else:
         port_name = "Com38"
 
-    uart0_component = SerialPortController.SerialPortController(port_name, 230400)
+    uart0_component = SerialPortController.SerialPortController(port_name, 230400, logging.DEBUG)
     uart0_component.start()
 
-    server = TcpSerialPortBridge(24, uart0_component)
+    net_engine = None
+    if args.netengine == "asyncio":
+        net_engine = AsyncNetEngine.AsyncNetEngine(logging.DEBUG)
+        net_engine.start()
+        server = AsyncTcpSerialPortBridge(net_engine, 24, uart0_component)
+    else:
+        server = TcpSerialPortBridge(24, uart0_component)
     server.start()
 
     time.sleep(3)
@@ -177,6 +389,8 @@ def main():
 
     uart0_component.stop()
     server.stop()
+    if net_engine is not None:
+        net_engine.stop()
 
     logging.info("Terminated")
 